@@ -169,6 +169,7 @@ class IncantExtensionScript(UIWrapper):
         def __init__(self):
                 self.stage_1 = [[]]
                 self.cached_c = [[None, None],[None, None]]
+                self.incant_params = None # IncantStateParams of the current job
                 self.infotext_fields = {}
                 self.paste_field_names = []
 
@@ -276,6 +277,7 @@ class IncantExtensionScript(UIWrapper):
                 self.incant_before_process_batch(p, *args, **kwargs)
 
         def incant_before_process_batch(self, p: StableDiffusionProcessing, inc_active, inc_quality, inc_deepbooru, inc_delim, inc_word, inc_gamma, inc_coarse_step, *args, **kwargs):
+                self.incant_params = None
                 inc_active = getattr(p, "incant_active", inc_active)
                 if inc_active is False:
                         return
@@ -386,15 +388,9 @@ class IncantExtensionScript(UIWrapper):
                         # assign old cache to next iteration
                         incant_params.first_stage_cache = self.stage_1
 
-                # Use lambda to call the callback function with the parameters to avoid global variables
-                y = lambda params: self.on_cfg_denoiser_callback(params, incant_params)
-                y2 = lambda params: self.cfg_after_cfg_callback(params, incant_params)
-                #y3 = lambda params: self.cfg_after_cfg_callback(params, incant_params)
+                self.incant_params = incant_params
 
                 logger.debug('Hooked callbacks')
-                #script_callbacks.on_cfg_denoised(y2)
-                script_callbacks.on_cfg_denoiser(y)
-                script_callbacks.on_cfg_after_cfg(y2)
                 script_callbacks.on_script_unloaded(self.unhook_callbacks)
         
         def calc_masked_prompt(self, incant_params: IncantStateParams, first_stage_cache):
@@ -458,10 +454,23 @@ class IncantExtensionScript(UIWrapper):
 
         def unhook_callbacks(self):
                 logger.debug('Unhooked callbacks')
+                self.incant_params = None
                 interrogator = self.interrogator(False)
                 interrogator.unload()
                 script_callbacks.remove_current_script_callbacks()
 
+        # Incant stage: swaps in the masked prompt conds and applies the guidance after cfg
+        def guidance_active(self) -> bool:
+                return self.incant_params is not None
+
+        def on_cfg_denoiser(self, params: CFGDenoiserParams):
+                if self.incant_params is not None:
+                        self.on_cfg_denoiser_callback(params, self.incant_params)
+
+        def on_cfg_after_cfg(self, params: AfterCFGCallbackParams):
+                if self.incant_params is not None:
+                        self.cfg_after_cfg_callback(params, self.incant_params)
+
         def on_cfg_denoiser_callback(self, params: CFGDenoiserParams, incant_params: IncantStateParams):
                 second_stage = incant_params.second_stage
                 if not second_stage:
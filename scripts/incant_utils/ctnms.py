@@ -0,0 +1,493 @@
+import logging
+import math
+from os import environ
+from typing import Optional
+
+import torch
+from torch.nn import functional as F
+
+from scripts.incant_utils.hook_manager import StepContext
+
+logger = logging.getLogger(__name__)
+logger.setLevel(environ.get("SD_WEBUI_LOG_LEVEL", logging.INFO))
+
+"""
+Cross-Token Non-Maximum Suppression of T2I-0, the per-job state and the hooks run on the cross attention modules.
+Only depends on torch, so the hooks can be tested without the webui.
+"""
+
+# Per Layer: every cross attention layer computes its own CTNMS token mask
+# Shared: the first layer of a forward computes the mask, the other layers resample it to their resolution
+CTNMS_MASK_MODES = [
+        'Per Layer',
+        'Shared',
+]
+
+# Stride: token masks are recomputed every mask stride steps and reused in between
+# Adaptive: token masks are recomputed when the output of the first layer drifts past the threshold since the last refresh
+CTNMS_MASK_REFRESH_MODES = [
+        'Stride',
+        'Adaptive',
+]
+
+# Full: EMA of the whole output in the output dtype
+# Half Precision: EMA stored in 16-bit floats
+# Downsampled: EMA stored at half the resolution of the layer and upsampled when read
+CTNMS_EMA_STORAGE_MODES = [
+        'Full',
+        'Half Precision',
+        'Downsampled',
+]
+
+
+class T2I0HookContext:
+        """ Per-job state read by the T2I-0 cross attention hooks
+        Step and parameter gating is kept on the host, so the hooks don't synchronize with the device
+        """
+        def __init__(self, alpha, width, height, ema_factor, step_start, step_end, tokens, token_count, mask_mode='Per Layer', mask_refresh='Stride', mask_stride=1, mask_drift=0.1, ema_storage='Full', ema_budget=0, tile_size=0):
+                self.alpha: float = alpha
+                self.width: int = width
+                self.height: int = height
+                self.step_start: int = step_start
+                self.step_end: int = step_end
+                self.ema_factor: float = ema_factor
+                self.token_count: int = token_count
+                self.tokens: Optional[list[int]] = list(tokens) if tokens is not None else None
+                self.ema = CTNMSEMAStore(ema_storage, ema_budget) # EMA of the suppressed attention maps
+                self.tile_size: int = int(tile_size) # latent pixels per tile, 0 is untiled
+                self.to_v_map: dict = {} # attention module -> to_v output of the current forward
+                self.plans: dict = {} # (sequence length, context length, dtype, device) -> CTNMSPlan
+                self.mask_mode: str = mask_mode
+                self.mask_refresh: str = mask_refresh
+                self.mask_stride: int = max(1, int(mask_stride))
+                self.mask_drift: float = mask_drift
+                self.reference_module = None # attention module that runs first in a forward, computes the shared token mask
+                self.forward_step: int = -1 # sampling step of the current forward
+                self.forward_index: int = 0 # index of the current forward in its step, e.g. the uncond chunk of the denoiser
+                self.refresh_masks: bool = True # whether the token masks of the current forward are recomputed
+                self.masks: dict = {} # forward index -> attention module (Per Layer) or (height, width) (Shared) -> token mask
+                self.mask_steps: dict = {} # forward index -> sampling step of the last refresh
+                self.mask_signatures: dict = {} # forward index -> pooled output of the reference module at the last refresh
+
+        def begin_forward(self, step: int, output: torch.Tensor):
+                """ Called by the reference module at the start of every forward, decides if the token masks of the forward are refreshed
+                Adaptive mode reads the drift back to the host, once per forward
+                """
+                if step != self.forward_step:
+                        self.forward_step = step
+                        self.forward_index = 0
+                else:
+                        self.forward_index += 1
+                key = self.forward_index
+                last_step = self.mask_steps.get(key)
+                signature = None
+                if last_step is None or step < last_step:
+                        refresh = True
+                elif self.mask_refresh == 'Adaptive':
+                        signature = output.detach().mean(dim=1, dtype=torch.float32)
+                        previous = self.mask_signatures.get(key)
+                        if previous is None or previous.shape != signature.shape:
+                                refresh = True
+                        else:
+                                drift = (signature - previous).norm() / previous.norm().clamp_min(1e-6)
+                                refresh = drift.item() > self.mask_drift
+                else:
+                        refresh = step - last_step >= self.mask_stride
+                if refresh:
+                        self.mask_steps[key] = step
+                        if self.mask_refresh == 'Adaptive':
+                                self.mask_signatures[key] = signature if signature is not None else output.detach().mean(dim=1, dtype=torch.float32)
+                self.refresh_masks = refresh
+
+
+def t2i0_to_v_hook(context: T2I0HookContext, step_context: StepContext, module, kwargs, output):
+        """ Keep the output of the to_v module of a cross attention module """
+        context.to_v_map[module] = output
+
+
+class CTNMSPlan:
+        """ CTNMS execution for one resolution and token selection, compiled once per job
+        Holds the latent layout of the layer, the device-resident selected token indices and the blur as a grouped conv weight
+        """
+        def __init__(self, t2i0_context: T2I0HookContext, sequence_length: int, context_length: int, dtype, device):
+                width, height = t2i0_context.width, t2i0_context.height
+                max_dims = width*height
+                factor = math.isqrt(max_dims // sequence_length) # should be a square of 2
+                self.factor = factor
+                self.downscale_width = width // factor
+                self.downscale_height = height // factor
+                self.valid = self.downscale_width * self.downscale_height == sequence_length
+                if not self.valid:
+                        logger.error(f"CTNMS layer size doesn't match the image: Width: {width}, height: {height}, Downscale width: {self.downscale_width}, height: {self.downscale_height}, Factor: {factor}, Max dims: {max_dims}")
+                        return
+
+                # Select token indices, default is ALL tokens
+                token_indices = t2i0_context.tokens
+                if token_indices is None or len(token_indices) == 0:
+                        end = min(t2i0_context.token_count, context_length)
+                        self.selected_tokens = torch.arange(1, end, device=device)
+                        self.token_slice = slice(1, end) # contiguous selection, read as a view
+                else:
+                        token_indices = [x for x in token_indices if x < context_length]
+                        self.selected_tokens = torch.tensor(token_indices, dtype=torch.int64, device=device)
+                        self.token_slice = None
+
+                # GaussianBlur(kernel_size=3, sigma=1) as a depthwise conv over the selected token maps
+                self.blur_weight = gaussian_blur_weight(len(self.selected_tokens), kernel_size=3, sigma=1.0, dtype=dtype, device=device)
+
+                # latent rows per tile, 0 if the layer fits in one tile
+                # an even number of rows, so a tile covers whole rows of a downsampled EMA buffer
+                tile_size = t2i0_context.tile_size
+                self.tile_rows = max(2, tile_size // self.downscale_width // 2 * 2) if 0 < tile_size < sequence_length else 0
+
+        def select_tokens(self, to_v_map: torch.Tensor) -> torch.Tensor:
+                """ Get the [batch, selected tokens, inner_dim] rows of the to_v output """
+                if self.token_slice is not None:
+                        return to_v_map[:, self.token_slice]
+                return to_v_map.index_select(1, self.selected_tokens)
+
+        @property
+        def blur_halo(self) -> int:
+                """ Rows on each side of a tile the blur reads """
+                return self.blur_weight.shape[-1] // 2
+
+        def blur(self, x: torch.Tensor, pad_top: bool = True, pad_bottom: bool = True) -> torch.Tensor:
+                """ Blur [batch, tokens, height, width] token maps like torchvision GaussianBlur
+                A tile that isn't at the top or bottom of the image passes its halo rows instead of padding,
+                the output then has the rows of the tile without the halo
+                """
+                pad = self.blur_halo
+                x = F.pad(x, (pad, pad, pad if pad_top else 0, pad if pad_bottom else 0), mode='reflect')
+                return F.conv2d(x, self.blur_weight, groups=x.shape[1])
+
+
+class CTNMSEMAStore:
+        """ EMA buffers of the suppressed attention maps, one per forward index and attention module
+        The buffers are stored according to the storage mode and never exceed the memory budget,
+        layers that don't fit the budget are not smoothed.
+        A buffer is allocated once and updated in place, a range of latent rows at a time when CTNMS is tiled.
+        """
+        def __init__(self, storage: str = 'Full', budget_mb: float = 0):
+                self.storage = storage
+                self.budget_bytes = int(budget_mb * 2 ** 20) # 0 is unlimited
+                self.buffers: dict = {} # (forward index, attention module) -> stored EMA
+                self.nbytes = 0
+                self.skipped = set() # keys whose EMA didn't fit the budget
+
+        def update(self, key, output: torch.Tensor, suppressed: torch.Tensor, ema_factor: float, plan: 'CTNMSPlan') -> Optional[torch.Tensor]:
+                """ Add the suppressed attention map of a whole layer to the EMA of key, the EMA starts from the output of the layer
+                Arguments:
+                        key: tuple - (forward index, attention module)
+                        output: torch.Tensor - [batch, height*width, inner_dim] output of the layer
+                        suppressed: torch.Tensor - suppressed attention map, same shape as output
+                        ema_factor: float - weight of the previous EMA
+                        plan: CTNMSPlan - plan of the layer, for the spatial layout
+                Returns:
+                        torch.Tensor - the EMA in the output dtype and shape, or None if it doesn't fit the budget
+                """
+                buffer = self.buffer(key, output, plan)
+                if buffer is None:
+                        return None
+                return self.update_rows(buffer, output, suppressed, ema_factor, plan, 0, plan.downscale_height)
+
+        def buffer(self, key, output: torch.Tensor, plan: 'CTNMSPlan') -> Optional[tuple[torch.Tensor, bool]]:
+                """ Get the EMA buffer of key for a layer output, allocated on first use
+                Returns:
+                        tuple[torch.Tensor, bool] - the buffer and whether it holds no EMA yet, or None if it doesn't fit the budget
+                """
+                shape, dtype = self.layout(output, plan)
+                stored = self.buffers.get(key)
+                if stored is not None and (stored.shape != shape or stored.dtype != dtype):
+                        self.release(key)
+                        stored = None
+                if stored is not None:
+                        return stored, False
+                if key in self.skipped:
+                        return None
+                if not self.fits(key, math.prod(shape) * torch.finfo(dtype).bits // 8):
+                        self.skipped.add(key)
+                        return None
+                stored = torch.empty(shape, dtype=dtype, device=output.device)
+                self.put(key, stored)
+                return stored, True
+
+        def layout(self, output: torch.Tensor, plan: 'CTNMSPlan') -> tuple[torch.Size, torch.dtype]:
+                """ Shape and dtype of the buffer of a layer output """
+                batch_size, sequence_length, inner_dim = output.shape
+                dtype = torch.float16 if self.storage == 'Half Precision' and output.dtype == torch.float32 else output.dtype
+                if self.storage == 'Downsampled' and plan.downscale_height % 2 == 0 and plan.downscale_width % 2 == 0:
+                        return torch.Size((batch_size, inner_dim, plan.downscale_height // 2, plan.downscale_width // 2)), dtype
+                return torch.Size((batch_size, sequence_length, inner_dim)), dtype
+
+        def update_rows(self, buffer: tuple[torch.Tensor, bool], output: torch.Tensor, suppressed: torch.Tensor, ema_factor: float, plan: 'CTNMSPlan', row_start: int, row_end: int) -> torch.Tensor:
+                """ Add the suppressed attention map of the latent rows [row_start, row_end) to the EMA in buffer
+                Arguments:
+                        buffer: tuple[torch.Tensor, bool] - from buffer()
+                        output: torch.Tensor - [batch, (row_end-row_start)*width, inner_dim] output of the rows
+                        suppressed: torch.Tensor - suppressed attention map of the rows, same shape as output
+                        row_start, row_end: int - latent rows, even for a downsampled buffer
+                Returns:
+                        torch.Tensor - the EMA of the rows in the output dtype and shape
+                """
+                stored, fresh = buffer
+                width = plan.downscale_width
+                downsampled = stored.dim() == 4
+                if fresh:
+                        previous = output.detach()
+                elif downsampled:
+                        x = F.interpolate(stored[:, :, row_start // 2:row_end // 2], scale_factor=2, mode='nearest')
+                        previous = x.flatten(2).transpose(1, 2).to(output.dtype)
+                else:
+                        previous = stored[:, row_start * width:row_end * width].to(output.dtype)
+                ema = ema_factor * previous + (1 - ema_factor) * suppressed
+                if downsampled:
+                        batch_size, _, inner_dim = ema.shape
+                        x = ema.transpose(1, 2).reshape(batch_size, inner_dim, row_end - row_start, width)
+                        stored[:, :, row_start // 2:row_end // 2] = F.avg_pool2d(x, 2)
+                else:
+                        stored[:, row_start * width:row_end * width] = ema
+                return ema
+
+        def fits(self, key, nbytes: int) -> bool:
+                if self.budget_bytes <= 0:
+                        return True
+                previous = self.buffers.get(key)
+                previous_bytes = tensor_nbytes(previous) if previous is not None else 0
+                if self.nbytes - previous_bytes + nbytes <= self.budget_bytes:
+                        return True
+                if len(self.skipped) == 0:
+                        logger.warning("T2I-0 CTNMS EMA buffers exceed the budget of %.1f MB, the remaining layers are not smoothed", self.budget_bytes / 2 ** 20)
+                return False
+
+        def put(self, key, stored: torch.Tensor):
+                self.release(key)
+                self.buffers[key] = stored
+                self.nbytes += tensor_nbytes(stored)
+
+        def release(self, key):
+                stored = self.buffers.pop(key, None)
+                if stored is not None:
+                        self.nbytes -= tensor_nbytes(stored)
+
+        def report(self) -> str:
+                return f"T2I-0 CTNMS EMA buffers: {self.nbytes / 2 ** 20:.1f} MB in {len(self.buffers)} buffers ({self.storage}), {len(self.skipped)} over budget"
+
+
+def tensor_nbytes(x: torch.Tensor) -> int:
+        return x.numel() * x.element_size()
+
+
+def gaussian_blur_weight(channels: int, kernel_size: int, sigma: float, dtype, device) -> torch.Tensor:
+        """ Depthwise conv weight of the torchvision gaussian blur kernel, [channels, 1, kernel_size, kernel_size] """
+        half = (kernel_size - 1) * 0.5
+        x = torch.linspace(-half, half, steps=kernel_size, dtype=torch.float32, device=device)
+        kernel_1d = torch.exp(-0.5 * (x / sigma).pow(2))
+        kernel_1d = kernel_1d / kernel_1d.sum()
+        kernel_2d = torch.outer(kernel_1d, kernel_1d).to(dtype=dtype)
+        return kernel_2d.expand(channels, 1, kernel_size, kernel_size).contiguous()
+
+
+def get_ctnms_plan(t2i0_context: T2I0HookContext, sequence_length: int, context_length: int, dtype, device) -> CTNMSPlan:
+        """ Get the plan of a layer, layers with the same resolution share it """
+        key = (sequence_length, context_length, dtype, device)
+        plan = t2i0_context.plans.get(key)
+        if plan is None:
+                plan = CTNMSPlan(t2i0_context, sequence_length, context_length, dtype, device)
+                t2i0_context.plans[key] = plan
+        return plan
+
+
+def ctnms_token_mask(plan: CTNMSPlan, to_v_map: torch.Tensor, output: torch.Tensor) -> torch.Tensor:
+        """ Get the index of the maximum contributing selected token of every pixel, [batch, height, width] """
+        # Multiply the text embeddings of the selected tokens into visual embeddings, the projection scales with the selection
+        # kept as [batch, tokens, height*width] so the blur needs no permute
+        if plan.tile_rows > 0:
+                return ctnms_token_mask_tiled(plan, to_v_map, output)
+        AC = plan.select_tokens(to_v_map) @ output.transpose(1, 2)
+        AC = AC.view(output.shape[0], -1, plan.downscale_height, plan.downscale_width)
+        AC = plan.blur(AC)  # Applying Gaussian smoothing
+        return torch.argmax(AC, dim=1)
+
+
+def ctnms_token_mask_tiled(plan: CTNMSPlan, to_v_map: torch.Tensor, output: torch.Tensor) -> torch.Tensor:
+        """ ctnms_token_mask over tiles of plan.tile_rows latent rows, only the token maps of one tile are materialized at once
+        Each tile projects a halo of blur_halo rows on both sides, so the mask equals the untiled one
+        """
+        batch_size = output.shape[0]
+        height, width = plan.downscale_height, plan.downscale_width
+        halo = plan.blur_halo
+        selected = plan.select_tokens(to_v_map)
+        M = torch.empty((batch_size, height, width), dtype=torch.int64, device=output.device)
+        for row_start in range(0, height, plan.tile_rows):
+                row_end = min(height, row_start + plan.tile_rows)
+                halo_start, halo_end = max(0, row_start - halo), min(height, row_end + halo)
+                AC = selected @ output[:, halo_start * width:halo_end * width].transpose(1, 2)
+                AC = AC.view(batch_size, -1, halo_end - halo_start, width)
+                AC = plan.blur(AC, pad_top=halo_start == row_start, pad_bottom=halo_end == row_end)
+                M[:, row_start:row_end] = torch.argmax(AC, dim=1)
+        return M
+
+
+def suppress_tiled_(plan: CTNMSPlan, to_v_map: torch.Tensor, M: torch.Tensor, output: torch.Tensor, alpha: float, ema_store: Optional[CTNMSEMAStore] = None, ema_buffer: Optional[tuple[torch.Tensor, bool]] = None, ema_factor: float = 0.0) -> torch.Tensor:
+        """ Blend the suppressed attention map into output in place, one tile of latent rows at a time
+        Arguments:
+                M: torch.Tensor - [batch, height*width] token mask
+                ema_store: CTNMSEMAStore (optional) - updates the EMA of each tile in ema_buffer
+                ema_buffer: tuple[torch.Tensor, bool] (optional) - EMA buffer of the layer from ema_store.buffer()
+                ema_factor: float - weight of the previous EMA
+        Returns:
+                torch.Tensor - output
+        """
+        height, width = plan.downscale_height, plan.downscale_width
+        for row_start in range(0, height, plan.tile_rows):
+                row_end = min(height, row_start + plan.tile_rows)
+                output_tile = output[:, row_start * width:row_end * width]
+                index = M[:, row_start * width:row_end * width].unsqueeze(-1).expand(-1, -1, to_v_map.size(-1))
+                suppressed = torch.gather(to_v_map, 1, index).mul_(output_tile)
+                if ema_buffer is not None:
+                        suppressed = ema_store.update_rows(ema_buffer, output_tile, suppressed, ema_factor, plan, row_start, row_end)
+                output_tile.mul_(1 - alpha).add_(suppressed, alpha=alpha)
+        return output
+
+
+def get_token_mask(t2i0_context: T2I0HookContext, step_context: StepContext, module, plan: CTNMSPlan, to_v_map: torch.Tensor, output: torch.Tensor) -> torch.Tensor:
+        """ Get the token mask of a layer, recomputed or reused from a previous step and resampled from the shared mask depending on the mask modes
+        Returns:
+                torch.Tensor - [batch, height, width] index of the maximum contributing selected token of every pixel
+        """
+        if t2i0_context.reference_module is None:
+                t2i0_context.reference_module = module
+        is_reference = module is t2i0_context.reference_module
+        if is_reference:
+                t2i0_context.begin_forward(step_context.sampling_step, output)
+        masks = t2i0_context.masks.setdefault(t2i0_context.forward_index, {})
+        shared_mask = t2i0_context.mask_mode == 'Shared'
+        batch_size = output.shape[0]
+        size = (plan.downscale_height, plan.downscale_width)
+
+        M = None
+        # the reference module has just refreshed the shared mask of this forward
+        if not t2i0_context.refresh_masks or (shared_mask and not is_reference):
+                if shared_mask:
+                        M = resample_token_mask(masks, batch_size, *size)
+                else:
+                        M = masks.get(module)
+                if M is not None and M.shape != (batch_size, *size):
+                        M = None
+        if M is None:
+                M = ctnms_token_mask(plan, to_v_map, output)
+                if not shared_mask:
+                        masks[module] = M
+                elif is_reference:
+                        masks.clear()
+                        masks[size] = M
+        return M
+
+
+def resample_token_mask(masks: dict, batch_size: int, height: int, width: int) -> Optional[torch.Tensor]:
+        """ Get the shared token mask of a forward at height x width, nearest resampled from the reference mask
+        Arguments:
+                masks: dict - (height, width) -> token mask, the first entry is the reference mask
+                batch_size: int - batch size of the layer output
+                height: int - height of the layer
+                width: int - width of the layer
+        Returns:
+                torch.Tensor - [batch, height, width] token mask, or None if there is no mask for this batch
+        """
+        if len(masks) == 0:
+                return None
+        M = masks.get((height, width))
+        if M is None:
+                reference = next(iter(masks.values()))
+                if reference.shape[0] != batch_size:
+                        return None
+                # token indices are exact in float32, nearest resampling keeps them whole
+                M = F.interpolate(reference.unsqueeze(1).float(), size=(height, width), mode='nearest').squeeze(1).long()
+                masks[(height, width)] = M
+        if M.shape[0] != batch_size:
+                return None
+        return M
+
+
+def cross_token_non_maximum_suppression(t2i0_context: T2I0HookContext, step_context: StepContext, module, kwargs, output):
+        """ Apply Cross-Token Non-Maximum Suppression to the output of a cross attention module """
+        # sampling step of the denoiser call, set by the base script
+        current_step = step_context.sampling_step
+
+        context = kwargs.get('context', None)
+        if context is None:
+                return
+        if context.shape[1] % 77 != 0:
+                logger.error("Context shape is not divisible by 77, cannot run T2I-0")
+                return
+
+        start_step = t2i0_context.step_start
+        end_step = t2i0_context.step_end
+
+        if current_step > end_step and end_step > 0:
+                return
+        if current_step < start_step:
+                return
+
+        to_v_map = t2i0_context.to_v_map[module]
+
+        # only the cond rows of the denoiser batch, the uncond rows are conditioned on the negative prompt
+        # forwards outside the denoiser batch are suppressed on every row
+        rows = step_context.cond_slice(output.shape[0])
+        if rows is None:
+                return suppress_tokens(t2i0_context, step_context, module, to_v_map, output)
+        if rows.stop == 0:
+                # a chunk of uncond rows, batch_cond_uncond is off
+                return
+        cond_output = output[rows]
+        out_tensor = suppress_tokens(t2i0_context, step_context, module, to_v_map[rows], cond_output)
+        if out_tensor is None:
+                return
+        if out_tensor is not cond_output:
+                cond_output.copy_(out_tensor)
+        return output
+
+
+def suppress_tokens(t2i0_context: T2I0HookContext, step_context: StepContext, module, to_v_map: torch.Tensor, output: torch.Tensor) -> Optional[torch.Tensor]:
+        """ Blend the suppressed attention map into the output rows of a cross attention module
+        Returns:
+                torch.Tensor - the new output, output itself if it was modified in place, or None if the layer was left unchanged
+        """
+        current_step = step_context.sampling_step
+        alpha = t2i0_context.alpha
+        batch_size, sequence_length, inner_dim = output.shape
+        dtype = output.dtype
+        device = output.device
+
+        plan = get_ctnms_plan(t2i0_context, sequence_length, to_v_map.size(-2), dtype, device)
+        if not plan.valid:
+                return
+
+        # Find the maximum contributing token for each pixel
+        M = get_token_mask(t2i0_context, step_context, module, plan, to_v_map, output)
+
+        # the tiles are blended into the output in place and update the EMA buffer tile by tile, no full size intermediates
+        if plan.tile_rows > 0:
+                ema_factor, ema_buffer = 0.0, None
+                if t2i0_context.ema_factor > 0:
+                        ema_factor = t2i0_context.ema_factor / (1 + current_step)
+                        ema_buffer = t2i0_context.ema.buffer((t2i0_context.forward_index, module), output, plan)
+                return suppress_tiled_(plan, to_v_map, M.view(batch_size, sequence_length), output, alpha, t2i0_context.ema, ema_buffer, ema_factor)
+
+        # Gather the to_v row of the maximum token for each pixel, the same rows a one-hot matmul would select
+        M = M.view(batch_size, sequence_length, 1).expand(-1, -1, to_v_map.size(-1))
+        M_z = torch.gather(to_v_map, 1, M)
+
+        suppressed_attention_map = M_z * output
+
+        # Calculate the EMA of the suppressed attention map
+        if t2i0_context.ema_factor > 0:
+                ema_factor = t2i0_context.ema_factor / (1 + current_step)
+                # Add the suppressed attention map to the EMA
+                ema = t2i0_context.ema.update((t2i0_context.forward_index, module), output, suppressed_attention_map, ema_factor, plan)
+                if ema is not None:
+                        suppressed_attention_map = ema
+                #out_tensor = (1-alpha) * ema + alpha * suppressed_attention_map
+        out_tensor = (1-alpha) * output + alpha * suppressed_attention_map
+
+        return out_tensor
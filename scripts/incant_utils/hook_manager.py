@@ -0,0 +1,174 @@
+import logging
+from contextlib import contextmanager
+from enum import IntFlag
+from os import environ
+from typing import Callable, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+logger.setLevel(environ.get("SD_WEBUI_LOG_LEVEL", logging.INFO))
+
+
+class PassType(IntFlag):
+        """ Kind of UNet forward, a hook route only runs on the passes it was installed for """
+        COND = 1 # cond rows of the denoiser forward
+        UNCOND = 2 # uncond rows of the denoiser forward, cleared when a guidance stage drops them from the batch
+        PERTURBED = 4 # auxiliary guidance branch, e.g. the PAG forward
+        PREVIEW = 8 # forwards outside the denoiser steps
+        DENOISE = COND | UNCOND
+        ALL = COND | UNCOND | PERTURBED | PREVIEW
+
+
+class StepContext:
+        """ Per-step state shared by every technique hook, updated once per denoiser call """
+        def __init__(self):
+                self.sampling_step: int = -1
+                self.total_sampling_steps: int = 0
+                self.pass_type: PassType = PassType.PREVIEW # passes of the current forward
+                self.cond_rows: int = 0 # cond rows at the start of the denoiser batch
+                self.batch_rows: int = 0 # rows of the denoiser batch after the guidance stages changed it
+                self.row_offset: int = 0 # first row of the current UNet forward in the denoiser batch
+
+        def reset(self):
+                self.sampling_step = -1
+                self.total_sampling_steps = 0
+                self.pass_type = PassType.PREVIEW
+                self.cond_rows = 0
+                self.batch_rows = 0
+                self.row_offset = 0
+
+        def cond_slice(self, batch_size: int) -> Optional[slice]:
+                """ Get the cond rows of a forward with batch_size rows
+                Every batch layout of the denoiser starts with the cond rows, e.g. [cond, uncond] or [cond, uncond, perturbed].
+                The denoiser runs the batch in chunks when batch_cond_uncond is off, row_offset is the first row of the chunk.
+                Returns an empty slice for a chunk of uncond rows, or None if the forward isn't part of the denoiser batch.
+                """
+                if self.cond_rows <= 0 or self.row_offset + batch_size > self.batch_rows:
+                        return None
+                return slice(0, max(0, min(batch_size, self.cond_rows - self.row_offset)))
+
+
+class HookManager:
+        """ Dispatches the forward hooks of every technique through one hook per module of a loaded model
+        Each technique adds a named route to the modules it hooks, installed once for the lifetime of the model.
+        A route only runs while a context object is active under its name, so enabling or disabling a technique
+        for a job doesn't touch the modules.
+
+        Hook functions are called as hook_fn(context, step_context, owner, kwargs, output) and must not be closures
+        over per-job state, since the first installed function stays in place for the lifetime of the model.
+        A hook function returns a new output or None to leave it unchanged, the next route sees the new output.
+        Routes are skipped on forwards whose pass type they weren't installed for, e.g. the PAG forward for T2I-0.
+        A forward can hold several passes, e.g. cond and uncond rows, StepContext.cond_slice gives the cond rows of it.
+        """
+        def __init__(self):
+                self.handles: dict[int, torch.utils.hooks.RemovableHandle] = {}
+                self.routes: dict[int, dict[str, tuple[Callable, torch.nn.Module, PassType]]] = {}
+                self.contexts: dict[str, object] = {}
+                self.step_context = StepContext()
+                self.row_handle: Optional[torch.utils.hooks.RemovableHandle] = None
+
+        def install(self, module: torch.nn.Module, name: str, hook_fn: Callable, owner: Optional[torch.nn.Module] = None, passes: PassType = PassType.ALL):
+                """ Route the forward of module to hook_fn unless a route with this name already exists on it
+                Arguments:
+                        module: torch.nn.Module - The module to hook
+                        name: str - The name of the technique, shared by every module it hooks
+                        hook_fn: Callable - Called with (context, step_context, owner, kwargs, output) while the context is active
+                        owner: torch.nn.Module (optional) - The module passed to hook_fn, defaults to module.
+                                Lets a hook on e.g. to_v keep its state under the attention module it belongs to.
+                        passes: PassType (optional) - The passes the hook runs on, defaults to all
+                """
+                key = id(module)
+                routes = self.routes.get(key)
+                if routes is None:
+                        routes = {}
+                        self.routes[key] = routes
+                        self.handles[key] = module.register_forward_hook(self.dispatch_hook(routes), with_kwargs=True)
+                if name not in routes:
+                        routes[name] = (hook_fn, module if owner is None else owner, passes)
+
+        def dispatch_hook(self, routes: dict):
+                contexts = self.contexts
+                step_context = self.step_context
+
+                def incant_dispatch_hook(module, args, kwargs, output):
+                        new_output = None
+                        pass_type = step_context.pass_type
+                        for name, (hook_fn, owner, passes) in routes.items():
+                                if not passes & pass_type:
+                                        continue
+                                context = contexts.get(name)
+                                if context is None:
+                                        continue
+                                result = hook_fn(context, step_context, owner, kwargs, output if new_output is None else new_output)
+                                if result is not None:
+                                        new_output = result
+                        return new_output
+                return incant_dispatch_hook
+
+        def track_rows(self, unet: torch.nn.Module):
+                """ Advance StepContext.row_offset past the rows of every forward of the UNet, so the hooks of a chunk see where it starts """
+                if self.row_handle is not None:
+                        return
+                step_context = self.step_context
+
+                def incant_row_hook(module, args, output):
+                        step_context.row_offset += output.shape[0]
+                self.row_handle = unet.register_forward_hook(incant_row_hook)
+
+        @contextmanager
+        def run_pass(self, pass_type: PassType):
+                """ Mark the forwards run inside the block as pass_type, e.g. an extra forward of a guidance branch """
+                previous = self.step_context.pass_type
+                self.step_context.pass_type = pass_type
+                try:
+                        yield
+                finally:
+                        self.step_context.pass_type = previous
+
+        def activate(self, name: str, context: object):
+                """ Run the routes with this name using context until deactivated """
+                self.contexts[name] = context
+
+        def deactivate(self, name: str):
+                self.contexts.pop(name, None)
+
+        def context(self, name: str) -> Optional[object]:
+                return self.contexts.get(name)
+
+        def uninstall(self, name: Optional[str] = None):
+                """ Remove the routes with this name, or every route if name is None
+                The dispatch hook of a module is removed with its last route, the row tracking hook with every route
+                """
+                for key in list(self.routes):
+                        routes = self.routes[key]
+                        for route_name in [route_name for route_name in routes if name is None or route_name == name]:
+                                del routes[route_name]
+                        if len(routes) == 0:
+                                del self.routes[key]
+                                self.handles.pop(key).remove()
+                if name is None:
+                        self.contexts.clear()
+                        if self.row_handle is not None:
+                                self.row_handle.remove()
+                                self.row_handle = None
+                else:
+                        self.contexts.pop(name, None)
+
+
+def get_hook_manager(model=None) -> Optional[HookManager]:
+        """ Get the hook manager of the loaded model, the hooks live as long as the model's modules """
+        if model is None:
+                # imported here so the hooks can run without the webui, e.g. in the tests
+                from modules import shared
+                model = shared.sd_model
+        if model is None:
+                return None
+        manager = getattr(model, 'incant_hook_manager', None)
+        if manager is None:
+                manager = HookManager()
+                setattr(model, 'incant_hook_manager', manager)
+        unet = getattr(getattr(model, 'model', None), 'diffusion_model', None)
+        if unet is not None:
+                manager.track_rows(unet)
+        return manager
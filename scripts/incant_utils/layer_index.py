@@ -0,0 +1,125 @@
+import logging
+import re
+from os import environ
+from typing import Optional
+
+import torch
+
+from modules import shared
+
+logger = logging.getLogger(__name__)
+logger.setLevel(environ.get("SD_WEBUI_LOG_LEVEL", logging.INFO))
+
+# e.g. diffusion_model_input_blocks_1_1_transformer_blocks_0_attn2, diffusion_model_middle_block_1_transformer_blocks_0_attn1
+LAYER_NAME_PATTERN = re.compile(r'(?P<block>input_blocks|middle_block|output_blocks)(?:_(?P<block_index>\d+))?_\d+_transformer_blocks_(?P<depth>\d+)_(?P<attn>attn[12])$')
+BLOCK_NAMES = {
+        'input_blocks': 'input',
+        'middle_block': 'middle',
+        'output_blocks': 'output',
+}
+
+
+class AttentionLayer:
+        def __init__(self, module: torch.nn.Module, name: str, block: str, block_index: int, depth: int, attn: str, level: int):
+                self.module = module
+                self.name = name # network_layer_name
+                self.block = block # 'input', 'middle' or 'output'
+                self.block_index = block_index # index into input_blocks/output_blocks, 0 for the middle block
+                self.depth = depth # index into transformer_blocks
+                self.attn = attn # 'attn1' (self-attention) or 'attn2' (cross-attention)
+                self.level = level # number of downsamples from the latent resolution
+
+        @property
+        def downscale(self) -> int:
+                """ Factor between the latent resolution and the resolution of this layer """
+                return 2 ** self.level
+
+
+class AttentionLayerIndex:
+        """ Index of the attention modules of a loaded model, built once from network_layer_mapping
+        Layers can be selected by block, block index, level, transformer depth and attention type
+        """
+        def __init__(self, model):
+                self.mapping = model.network_layer_mapping
+                self.layers: list[AttentionLayer] = []
+                input_levels, middle_level, output_levels = unet_levels(model.model.diffusion_model)
+                for name, module in self.mapping.items():
+                        if 'CrossAttention' not in module.__class__.__name__:
+                                continue
+                        match = LAYER_NAME_PATTERN.search(name)
+                        if match is None:
+                                continue
+                        block = BLOCK_NAMES[match.group('block')]
+                        block_index = int(match.group('block_index') or 0)
+                        if block == 'input':
+                                level = input_levels[block_index]
+                        elif block == 'output':
+                                level = output_levels[block_index]
+                        else:
+                                level = middle_level
+                        self.layers.append(AttentionLayer(module, name, block, block_index, int(match.group('depth')), match.group('attn'), level))
+                self._selections = {}
+
+        def is_valid_for(self, model) -> bool:
+                return getattr(model, 'network_layer_mapping', None) is self.mapping
+
+        def select(self, block: Optional[str] = None, attn: Optional[str] = None, level: Optional[int] = None, block_index: Optional[int] = None, depth: Optional[int] = None) -> list[torch.nn.Module]:
+                """ Get the attention modules matching every given criterion, in network order
+                Arguments:
+                        block: str - 'input', 'middle' or 'output'
+                        attn: str - 'attn1' or 'attn2'
+                        level: int - number of downsamples from the latent resolution
+                        block_index: int - index into input_blocks/output_blocks
+                        depth: int - index into transformer_blocks
+                Returns:
+                        list[torch.nn.Module] - the matching modules
+                """
+                key = (block, attn, level, block_index, depth)
+                modules = self._selections.get(key)
+                if modules is None:
+                        modules = [layer.module for layer in self.layers if
+                                (block is None or layer.block == block) and
+                                (attn is None or layer.attn == attn) and
+                                (level is None or layer.level == level) and
+                                (block_index is None or layer.block_index == block_index) and
+                                (depth is None or layer.depth == depth)
+                        ]
+                        self._selections[key] = modules
+                return list(modules)
+
+
+def unet_levels(unet):
+        """ Get the resolution level of every input and output block of the UNet by counting the resampling layers before it
+        Returns:
+                tuple[list[int], int, list[int]] - input block levels, middle block level, output block levels
+        """
+        input_levels = []
+        level = 0
+        for block in unet.input_blocks:
+                input_levels.append(level)
+                if any('Downsample' in layer.__class__.__name__ for layer in block):
+                        level += 1
+        middle_level = level
+        output_levels = []
+        for block in unet.output_blocks:
+                output_levels.append(level)
+                if any('Upsample' in layer.__class__.__name__ for layer in block):
+                        level -= 1
+        return input_levels, middle_level, output_levels
+
+
+def get_layer_index(model=None) -> Optional[AttentionLayerIndex]:
+        """ Get the attention layer index of the loaded model
+        The index is stored on the model and rebuilt when the model or its network_layer_mapping changes
+        """
+        if model is None:
+                model = shared.sd_model
+        try:
+                index = getattr(model, 'incant_layer_index', None)
+                if index is None or not index.is_valid_for(model):
+                        index = AttentionLayerIndex(model)
+                        setattr(model, 'incant_layer_index', index)
+                return index
+        except AttributeError:
+                logger.exception("AttributeError while building attention layer index")
+                return None
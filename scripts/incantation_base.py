@@ -5,9 +5,11 @@ import gradio as gr
 from dataclasses import dataclass
 from typing import Any
 
-from modules import script_callbacks
+from modules import script_callbacks, sd_models, patches
 from modules.processing import StableDiffusionProcessing
+from modules.script_callbacks import CFGDenoiserParams, CFGDenoisedParams, AfterCFGCallbackParams
 from scripts.ui_wrapper import UIWrapper
+from scripts.incant_utils.hook_manager import PassType, get_hook_manager
 from scripts.incant import IncantExtensionScript
 from scripts.t2i_zero import T2I0ExtensionScript
 from scripts.pag import PAGExtensionScript
@@ -34,6 +36,65 @@ submodules: list[SubmoduleInfo] = [
         SubmoduleInfo(module=T2I0ExtensionScript()),
         SubmoduleInfo(module=IncantExtensionScript()),
 ]
+
+
+class GuidancePipeline:
+        """ Runs the guidance stages of every submodule from one set of denoiser callbacks
+        Stages run in guidance_order, so conditioning edits are done before PAG builds its perturbed batch.
+        combine_denoised is patched once per denoiser, the first active stage that combines the predictions takes over.
+        """
+        def __init__(self, stages: list[UIWrapper]):
+                self.stages = sorted(stages, key=lambda stage: stage.guidance_order)
+                self.denoiser = None # CFGDenoiser with the patched combine_denoised
+
+        def active_stages(self) -> list[UIWrapper]:
+                return [stage for stage in self.stages if stage.guidance_active()]
+
+        def on_cfg_denoiser(self, params: CFGDenoiserParams):
+                stages = self.active_stages()
+                if len(stages) == 0:
+                        return
+                if params.denoiser is not self.denoiser:
+                        self.patch_denoiser(params.denoiser)
+                for stage in stages:
+                        stage.on_cfg_denoiser(params)
+
+        def on_cfg_denoised(self, params: CFGDenoisedParams):
+                for stage in self.active_stages():
+                        stage.on_cfg_denoised(params)
+
+        def on_cfg_after_cfg(self, params: AfterCFGCallbackParams):
+                for stage in self.active_stages():
+                        stage.on_cfg_after_cfg(params)
+
+        def combine_denoised(self, original_func, x_out, conds_list, uncond, cond_scale):
+                for stage in self.active_stages():
+                        denoised = stage.combine_denoised(x_out, conds_list, uncond, cond_scale)
+                        if denoised is not None:
+                                return denoised
+                return original_func(x_out, conds_list, uncond, cond_scale)
+
+        def patch_denoiser(self, denoiser):
+                """ Patch combine_denoised of a new denoiser, the previous one is restored """
+                self.unpatch_denoiser()
+                try:
+                        original_func = denoiser.combine_denoised
+                        patches.patch(__name__, denoiser, "combine_denoised", lambda *args: self.combine_denoised(original_func, *args))
+                        self.denoiser = denoiser
+                except RuntimeError:
+                        logger.exception("RuntimeError patching combine_denoised")
+
+        def unpatch_denoiser(self):
+                if self.denoiser is None:
+                        return
+                try:
+                        patches.undo(__name__, self.denoiser, "combine_denoised")
+                except (KeyError, RuntimeError):
+                        logger.exception("Error unpatching combine_denoised")
+                self.denoiser = None
+
+
+guidance_pipeline = GuidancePipeline([m.module for m in submodules])
                 
 class IncantBaseExtensionScript(scripts.Script):
         def __init__(self):
@@ -83,12 +144,20 @@ class IncantBaseExtensionScript(scripts.Script):
                         m.module.before_process_batch(p, *self.m_args(m, *args), **kwargs)
         
         def process_batch(self, p: StableDiffusionProcessing, *args, **kwargs):
+                manager = get_hook_manager()
+                if manager is not None:
+                        manager.step_context.reset()
                 for m in submodules:
                         m.module.process_batch(p, *self.m_args(m, *args), **kwargs)
 
         def postprocess_batch(self, p: StableDiffusionProcessing, *args, **kwargs):
                 for m in submodules:
                         m.module.postprocess_batch(p, *self.m_args(m, *args), **kwargs)
+                guidance_pipeline.unpatch_denoiser()
+                # forwards after sampling are not part of a denoiser step
+                manager = get_hook_manager()
+                if manager is not None:
+                        manager.step_context.reset()
 
         def unhook_callbacks(self):
                 for m in submodules:
@@ -121,3 +190,57 @@ def callback_before_ui():
                 logger.exception("Incantation: Error while making axis options")
 
 script_callbacks.on_before_ui(callback_before_ui)
+
+
+# Attention hooks
+# Every technique routes its attention hooks through the one dispatch hook per module of the HookManager
+def callback_cfg_denoiser(params: CFGDenoiserParams):
+        """ Update the step context shared by the technique hooks, once per denoiser call for all techniques """
+        manager = get_hook_manager()
+        if manager is None:
+                return
+        manager.step_context.sampling_step = params.sampling_step
+        manager.step_context.total_sampling_steps = params.total_sampling_steps
+        manager.step_context.pass_type = PassType.DENOISE
+
+
+def callback_cfg_denoiser_batch_layout(params: CFGDenoiserParams):
+        """ Record the layout of the denoiser batch, after the guidance stages added or dropped rows
+        The layout is [cond, uncond, perturbed], a forward without uncond rows is only tagged as a cond pass.
+        The UNet forwards of the step count their rows from here, see HookManager.track_rows
+        """
+        manager = get_hook_manager()
+        if manager is None:
+                return
+        step_context = manager.step_context
+        text_cond = params.text_cond['crossattn'] if isinstance(params.text_cond, dict) else params.text_cond
+        step_context.cond_rows = text_cond.shape[0]
+        step_context.batch_rows = params.x.shape[0]
+        step_context.row_offset = 0
+        # the perturbed rows of a fused PAG batch are a copy of the cond rows
+        perturbed_rows = step_context.cond_rows if step_context.pass_type & PassType.PERTURBED else 0
+        if step_context.batch_rows - step_context.cond_rows - perturbed_rows <= 0:
+                step_context.pass_type &= ~PassType.UNCOND
+
+
+def callback_script_unloaded():
+        """ Remove the dispatch hooks from the model, the reloaded scripts install them again """
+        guidance_pipeline.unpatch_denoiser()
+        try:
+                # don't load a model just to unhook it
+                model = getattr(getattr(sd_models, 'model_data', None), 'sd_model', None)
+                manager = getattr(model, 'incant_hook_manager', None)
+                if manager is not None:
+                        manager.uninstall()
+        except:
+                logger.exception("Incantation: Error while removing attention hooks")
+
+script_callbacks.on_cfg_denoiser(callback_cfg_denoiser)
+script_callbacks.on_script_unloaded(callback_script_unloaded)
+
+
+# Guidance pipeline
+script_callbacks.on_cfg_denoiser(guidance_pipeline.on_cfg_denoiser)
+script_callbacks.on_cfg_denoiser(callback_cfg_denoiser_batch_layout)
+script_callbacks.on_cfg_denoised(guidance_pipeline.on_cfg_denoised)
+script_callbacks.on_cfg_after_cfg(guidance_pipeline.on_cfg_after_cfg)
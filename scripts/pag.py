@@ -5,14 +5,14 @@ import gradio as gr
 import scipy.stats as stats
 
 from scripts.ui_wrapper import UIWrapper, arg
-from modules import script_callbacks, patches
+from scripts.incant_utils.layer_index import get_layer_index
+from scripts.incant_utils.hook_manager import PassType, StepContext, get_hook_manager
 from modules.hypernetworks import hypernetwork
 #import modules.sd_hijack_optimizations
 from modules.script_callbacks import CFGDenoiserParams, CFGDenoisedParams, AfterCFGCallbackParams
 from modules.prompt_parser import reconstruct_multicond_batch
 from modules.processing import StableDiffusionProcessing
 #from modules.shared import sd_model, opts
-from modules.sd_samplers_cfg_denoiser import catenate_conds
 from modules.sd_samplers_cfg_denoiser import CFGDenoiser
 from modules import shared
 
@@ -21,10 +21,10 @@ import torch
 from torch.nn import functional as F
 from torchvision.transforms import GaussianBlur
 
-from warnings import warn
 from typing import Callable, Dict, Optional
-from collections import OrderedDict
-import torch
+from contextlib import contextmanager
+from functools import partial
+import copy
 
 logger = logging.getLogger(__name__)
 logger.setLevel(environ.get("SD_WEBUI_LOG_LEVEL", logging.INFO))
@@ -75,24 +75,13 @@ GitHub URL: https://github.com/v0xie/sd-webui-incantations
 handles = []
 global_scale = 1
 
-SCHEDULES = [
-        'Constant',
-        'Clamp-Linear (c=4.0)',
-        'Clamp-Linear (c=2.0)',
-        'Clamp-Linear (c=1.0)',
-        'Linear',
-        'Inverse-Linear',
-        'Cosine',
-        'Clamp-Cosine (c=4.0)',
-        'Clamp-Cosine (c=2.0)',
-        'Clamp-Cosine (c=1.0)',
-        'Sine',
-        'Interval',
-        'PCS (s=0.01)',
-        'PCS (s=0.1)',
-        'PCS (s=1.0)',
-        'PCS (s=2.0)',
-        'PCS (s=4.0)',
+# Fused: perturbed branch is concatenated into the cond/uncond batch of the CFG denoiser
+# Separate: perturbed branch runs as an extra forward after the cond/uncond forward
+# Reuse Activations: extra forward that replays the UNet input block activations of the cond rows
+BATCH_MODES = [
+        'Fused',
+        'Separate',
+        'Reuse Activations',
 ]
 
 
@@ -105,6 +94,9 @@ class PAGStateParams:
                 self.cfg_interval_schedule: str = 'Constant'
                 self.cfg_interval_low: float = 0
                 self.cfg_interval_high: float = 50.0
+                self.cfg_table = None # CFGScheduleTable of the current sampler pass
+                self.cfg_table_key = None # (denoiser id, total sampling steps) the table was built for
+                self.combine_plan = None # CombinePlan of the conds_list of this job
                 self.step : int = 0 
                 self.max_sampling_step : int = 1 
                 self.guidance_scale: int = -1 # CFG
@@ -119,16 +111,39 @@ class PAGStateParams:
                 self.to_out_modules = []
                 self.pag_x_out = None
                 self.batch_size = -1      # Batch size
-                self.denoiser = None # CFGDenoiser
-                self.patched_combine_denoised = None
                 self.conds_list = None
                 self.uncond_shape_0 = None
+                self.batch_mode: str = 'Separate'
+                self.perturbation: str = 'Identity' # name in PERTURBATION_REGISTRY
+                self.cfg_free: bool = False # PAG is the only guidance during PAG steps, the uncond branch is skipped
+                self.pag_rows: int = 0 # number of perturbed rows appended to the batch this step (Fused only)
+                self.activation_cache = None # UNetActivationCache (Reuse Activations only)
+                self.single_cond: bool = False # every image of the current step has one cond with weight 1 (no AND)
+                self.hook_context = None # PAGHookContext read by the attention hooks
+
+
+# name of the PAG hooks in the HookManager
+PAG_HOOK_NAME = 'pag'
+
+
+class PAGHookContext:
+        """ Per-job state read by the PAG attention hooks """
+        def __init__(self, perturbation: Callable, image_size: tuple[int, int]):
+                self.enable: bool = False # apply the perturbation on this forward
+                self.rows: slice = slice(None) # rows of the batch that belong to the perturbed branch, all rows unless fused
+                self.perturbation = perturbation
+                self.image_size = image_size # (width, height)
+                self.last_to_v: dict = {} # attention module -> to_v output of the current PAG forward
 
 
 class PAGExtensionScript(UIWrapper):
+        # PAG runs after the conditioning edits of the other techniques, so the perturbed branch sees the edited conditioning
+        guidance_order = 1
+
         def __init__(self):
                 self.cached_c = [None, None]
                 self.handles = []
+                self.pag_params = None # PAGStateParams of the current job
 
         # Extension title in menu UI
         def title(self) -> str:
@@ -144,14 +159,30 @@ class PAGExtensionScript(UIWrapper):
                         active = gr.Checkbox(value=False, default=False, label="Active", elem_id='pag_active')
                         with gr.Row():
                                 pag_scale = gr.Slider(value = 0, minimum = 0, maximum = 20.0, step = 0.5, label="PAG Scale", elem_id = 'pag_scale', info="")
+                                cfg_free = gr.Checkbox(value=False, default=False, label="CFG-Free", elem_id='pag_cfg_free', info="During PAG steps, skip the uncond branch and use PAG as the only guidance. Two UNet evaluations per step instead of three.")
                         with gr.Row():
                                 start_step = gr.Slider(value = 0, minimum = 0, maximum = 150, step = 1, label="Start Step", elem_id = 'pag_start_step', info="")
                                 end_step = gr.Slider(value = 150, minimum = 0, maximum = 150, step = 1, label="End Step", elem_id = 'pag_end_step', info="")
+                        with gr.Row():
+                                batch_mode = gr.Dropdown(
+                                        value='Separate',
+                                        choices=BATCH_MODES,
+                                        label="Batch Mode",
+                                        elem_id='pag_batch_mode',
+                                        info="Fused evaluates the perturbed branch in the same UNet batch as cond/uncond. Separate runs it as an extra forward (lower peak VRAM). Reuse Activations runs the extra forward from the middle block using the input block activations of the cond pass (these include T2I-0 CTNMS edits, so results differ from Separate when both are on).",
+                                )
+                                perturbation = gr.Dropdown(
+                                        value='Identity',
+                                        choices=perturbation_names(),
+                                        label="Perturbation",
+                                        elem_id='pag_perturbation',
+                                        info="Identity replaces self-attention with the identity map (PAG paper). Blur uses a blurred identity map, Masked replaces every other token.",
+                                )
                         with gr.Row():
                                 cfg_interval_enable = gr.Checkbox(value=False, default=False, label="Enable CFG Scheduler", elem_id='cfg_interval_enable', info="If enabled, applies CFG only within noise interval with the selected schedule type. PAG must be enabled (scale can be 0). SDXL recommend CFG=15; CFG interval (0.28, 5.42]")
                                 cfg_schedule = gr.Dropdown(
                                         value='Constant',
-                                        choices= SCHEDULES,
+                                        choices= schedule_names(),
                                         label="CFG Schedule Type", 
                                         elem_id='cfg_interval_schedule', 
                                 )
@@ -167,11 +198,17 @@ class PAGExtensionScript(UIWrapper):
                 cfg_schedule.do_not_save_to_config = True
                 cfg_interval_low.do_not_save_to_config = True
                 cfg_interval_high.do_not_save_to_config = True
+                batch_mode.do_not_save_to_config = True
+                cfg_free.do_not_save_to_config = True
+                perturbation.do_not_save_to_config = True
                 self.infotext_fields = [
                         (active, lambda d: gr.Checkbox.update(value='PAG Active' in d)),
                         (pag_scale, 'PAG Scale'),
                         (start_step, 'PAG Start Step'),
                         (end_step, 'PAG End Step'),
+                        (cfg_free, 'PAG CFG Free'),
+                        (perturbation, 'PAG Perturbation'),
+                        (batch_mode, 'PAG Batch Mode'),
                         (cfg_interval_enable, 'CFG Interval Enable'),
                         (cfg_schedule, 'CFG Interval Schedule'),
                         (cfg_interval_low, 'CFG Interval Low'),
@@ -182,19 +219,21 @@ class PAGExtensionScript(UIWrapper):
                         'pag_scale',
                         'pag_start_step',
                         'pag_end_step',
+                        'pag_cfg_free',
+                        'pag_perturbation',
+                        'pag_batch_mode',
                         'cfg_interval_enable',
                         'cfg_interval_schedule',
                         'cfg_interval_low',
                         'cfg_interval_high',
                 ]
-                return [active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high]
+                return [active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high, batch_mode, cfg_free, perturbation]
 
         def process_batch(self, p: StableDiffusionProcessing, *args, **kwargs):
                self.pag_process_batch(p, *args, **kwargs)
 
-        def pag_process_batch(self, p: StableDiffusionProcessing, active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high, *args, **kwargs):
+        def pag_process_batch(self, p: StableDiffusionProcessing, active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high, batch_mode, cfg_free, perturbation, *args, **kwargs):
                 # cleanup previous hooks always
-                script_callbacks.remove_current_script_callbacks()
                 self.remove_all_hooks()
 
                 active = getattr(p, "pag_active", active)
@@ -208,20 +247,26 @@ class PAGExtensionScript(UIWrapper):
                 cfg_schedule = getattr(p, "cfg_interval_schedule", cfg_schedule)
                 cfg_interval_low = getattr(p, "cfg_interval_low", cfg_interval_low)
                 cfg_interval_high = getattr(p, "cfg_interval_high", cfg_interval_high)
+                batch_mode = getattr(p, "pag_batch_mode", batch_mode)
+                cfg_free = getattr(p, "pag_cfg_free", cfg_free)
+                perturbation = getattr(p, "pag_perturbation", perturbation)
 
                 p.extra_generation_params.update({
                         "PAG Active": active,
                         "PAG Scale": pag_scale,
                         "PAG Start Step": start_step,
                         "PAG End Step": end_step,
+                        "PAG CFG Free": cfg_free,
+                        "PAG Perturbation": perturbation,
+                        "PAG Batch Mode": batch_mode,
                         "CFG Interval Enable": cfg_interval_enable,
                         "CFG Interval Schedule": cfg_schedule,
                         "CFG Interval Low": cfg_interval_low,
                         "CFG Interval High": cfg_interval_high
                 })
-                self.create_hook(p, active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high)
+                self.create_hook(p, active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high, batch_mode, cfg_free, perturbation)
 
-        def create_hook(self, p: StableDiffusionProcessing, active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high, *args, **kwargs):
+        def create_hook(self, p: StableDiffusionProcessing, active, pag_scale, start_step, end_step, cfg_interval_enable, cfg_schedule, cfg_interval_low, cfg_interval_high, batch_mode, cfg_free, perturbation, *args, **kwargs):
                 # Create a list of parameters for each concept
                 pag_params = PAGStateParams()
                 pag_params.pag_scale = pag_scale
@@ -232,16 +277,26 @@ class PAGExtensionScript(UIWrapper):
                 pag_params.max_sampling_step = p.steps
                 pag_params.guidance_scale = p.cfg_scale
                 pag_params.batch_size = p.batch_size
-                pag_params.denoiser = None
+                pag_params.batch_mode = batch_mode
+                pag_params.cfg_free = cfg_free
+                pag_params.perturbation = perturbation
+                if perturbation not in PERTURBATION_REGISTRY:
+                        logger.error(f"Invalid PAG perturbation: {perturbation}")
+                        pag_params.perturbation = 'Identity'
+
+                if batch_mode == 'Reuse Activations':
+                        unet = get_unet()
+                        if unet is not None and hasattr(unet, 'input_blocks'):
+                                pag_params.activation_cache = UNetActivationCache(unet)
+                        else:
+                                logger.warning("UNet input blocks not found, PAG falls back to Separate batch mode")
 
-                if pag_params.cfg_interval_enable:
-                       # Refer to 3.1 Practice in the paper
-                       # We want to round high and low noise levels to the nearest integer index
-                       low_index = find_closest_index(cfg_interval_low, pag_params.max_sampling_step)
-                       high_index = find_closest_index(cfg_interval_high, pag_params.max_sampling_step)
-                       pag_params.cfg_interval_low = calculate_noise_level(low_index, pag_params.max_sampling_step)
-                       pag_params.cfg_interval_high = calculate_noise_level(high_index, pag_params.max_sampling_step)
-                       logger.debug(f"Step Aligned CFG Interval (low, high): ({low_index}, {high_index}), Step Aligned CFG Interval: ({round(pag_params.cfg_interval_low, 4)}, {round(pag_params.cfg_interval_high, 4)})")
+                # the interval is aligned to the sampling steps when the per-step table is built
+                pag_params.cfg_interval_low = cfg_interval_low
+                pag_params.cfg_interval_high = cfg_interval_high
+                if pag_params.cfg_interval_schedule not in SCHEDULE_REGISTRY:
+                        logger.error(f"Invalid CFG schedule: {pag_params.cfg_interval_schedule}")
+                        pag_params.cfg_interval_schedule = 'Constant'
 
                 # Get all the qv modules
                 cross_attn_modules = self.get_cross_attn_modules()
@@ -249,26 +304,18 @@ class PAGExtensionScript(UIWrapper):
                         logger.error("No cross attention modules found, cannot proceed with PAG")
                         return
                 pag_params.crossattn_modules = [m for m in cross_attn_modules if 'CrossAttention' in m.__class__.__name__]
+                pag_params.hook_context = PAGHookContext(PERTURBATION_REGISTRY[pag_params.perturbation], (p.width, p.height))
 
-                # Use lambda to call the callback function with the parameters to avoid global variables
-                cfg_denoise_lambda = lambda callback_params: self.on_cfg_denoiser_callback(callback_params, pag_params)
-                cfg_denoised_lambda = lambda callback_params: self.on_cfg_denoised_callback(callback_params, pag_params)
-                #after_cfg_lambda = lambda x: self.cfg_after_cfg_callback(x, params)
-                unhook_lambda = lambda _: self.unhook_callbacks(pag_params)
-
-                self.ready_hijack_forward(pag_params.crossattn_modules, pag_scale)
+                self.ready_hijack_forward(pag_params.crossattn_modules, pag_params.hook_context)
 
+                self.pag_params = pag_params
                 logger.debug('Hooked callbacks')
-                script_callbacks.on_cfg_denoiser(cfg_denoise_lambda)
-                script_callbacks.on_cfg_denoised(cfg_denoised_lambda)
-                #script_callbacks.on_cfg_after_cfg(after_cfg_lambda)
-                script_callbacks.on_script_unloaded(unhook_lambda)
 
         def postprocess_batch(self, p, *args, **kwargs):
                 self.pag_postprocess_batch(p, *args, **kwargs)
 
         def pag_postprocess_batch(self, p, active, *args, **kwargs):
-                script_callbacks.remove_current_script_callbacks()
+                self.remove_all_hooks()
 
                 logger.debug('Removed script callbacks')
                 active = getattr(p, "pag_active", active)
@@ -276,80 +323,49 @@ class PAGExtensionScript(UIWrapper):
                         return
 
         def remove_all_hooks(self):
-                cross_attn_modules = self.get_cross_attn_modules()
-                for module in cross_attn_modules:
-                        to_v = getattr(module, 'to_v', None)
-                        self.remove_field_cross_attn_modules(module, 'pag_enable')
-                        self.remove_field_cross_attn_modules(module, 'pag_last_to_v')
-                        self.remove_field_cross_attn_modules(to_v, 'pag_parent_module')
-                        _remove_all_forward_hooks(module, 'pag_pre_hook')
-                        _remove_all_forward_hooks(to_v, 'to_v_pre_hook')
-
-        def unhook_callbacks(self, pag_params: PAGStateParams):
-                global handles
-
-                if pag_params is None:
-                       logger.error("PAG params is None")
-                       return
-
-                if pag_params.denoiser is not None:
-                        denoiser = pag_params.denoiser
-                        setattr(denoiser, 'combine_denoised_patched', False)
-                        try:
-                                patches.undo(__name__, denoiser, "combine_denoised")
-                        except KeyError:
-                                logger.exception("KeyError unhooking combine_denoised")
-                                pass
-                        except RuntimeError:
-                                logger.exception("RuntimeError unhooking combine_denoised")
-                                pass
-                        pag_params.denoiser = None
-
-
-        def ready_hijack_forward(self, crossattn_modules, pag_scale):
-                """ Create hooks in the forward pass of the cross attention modules
-                Copies the output of the to_v module to the parent module
-                Then applies the PAG perturbation to the output of the cross attention module (multiplication by identity)
-                """
+                """ Deactivate the PAG hooks of the previous job, the hooks stay installed on the model """
+                manager = get_hook_manager()
+                if manager is not None:
+                        manager.deactivate(PAG_HOOK_NAME)
+                # an interrupted job may leave the input blocks capturing
+                if self.pag_params is not None and self.pag_params.activation_cache is not None:
+                        self.pag_params.activation_cache.release()
+                self.pag_params = None
+
+        def unhook_callbacks(self):
+                self.remove_all_hooks()
 
-                # add field for last_to_v
-                for module in crossattn_modules:
-                        to_v = getattr(module, 'to_v', None)
-                        self.add_field_cross_attn_modules(module, 'pag_enable', False)
-                        self.add_field_cross_attn_modules(module, 'pag_last_to_v', None)
-                        self.add_field_cross_attn_modules(to_v, 'pag_parent_module', [module])
-                        # self.add_field_cross_attn_modules(to_out, 'pag_parent_module', [module])
-
-                def to_v_pre_hook(module, input, kwargs, output):
-                        """ Copy the output of the to_v module to the parent module """
-                        parent_module = getattr(module, 'pag_parent_module', None)
-                        # copy the output of the to_v module to the parent module
-                        setattr(parent_module[0], 'pag_last_to_v', output.detach().clone())
-
-                def pag_pre_hook(module, input, kwargs, output):
-                        if hasattr(module, 'pag_enable') and getattr(module, 'pag_enable', False) is False:
-                                return
-                        if not hasattr(module, 'pag_last_to_v'):
-                                # oops we forgot to unhook
-                                return
+        # PAG stage: adds the perturbed pass to the batch and combines it into the denoised output
+        def guidance_active(self) -> bool:
+                return self.pag_params is not None
 
-                        batch_size, seq_len, inner_dim = output.shape
-                        identity = torch.eye(seq_len).expand(batch_size, -1, -1).to(shared.device)
+        def on_cfg_denoiser(self, params: CFGDenoiserParams):
+                if self.pag_params is not None:
+                        self.on_cfg_denoiser_callback(params, self.pag_params)
 
-                        # get the last to_v output and save it
-                        last_to_v = getattr(module, 'pag_last_to_v', None)
-                        if last_to_v is not None:    
-                                new_output = torch.einsum('bij,bjk->bik', identity, last_to_v)
-                                return new_output
-                        else:
-                                # this is bad
-                                return output
+        def on_cfg_denoised(self, params: CFGDenoisedParams):
+                if self.pag_params is not None:
+                        self.on_cfg_denoised_callback(params, self.pag_params)
+
+        def combine_denoised(self, x_out, conds_list, uncond, cond_scale):
+                if self.pag_params is None:
+                        return None
+                return combine_denoised_pass_conds_list(x_out, conds_list, uncond, cond_scale, pag_params=self.pag_params)
 
-                # Create hooks 
+        def ready_hijack_forward(self, crossattn_modules, hook_context: PAGHookContext):
+                """ Install the PAG hooks on the cross attention modules and activate them for this job
+                The hooks are only installed the first time, later jobs swap in their own context
+                Copies the output of the to_v module to the context
+                Then applies the PAG perturbation to the output of the cross attention module (identity by default)
+                """
+                manager = get_hook_manager()
+                if manager is None:
+                        logger.error("No model loaded, cannot hook PAG")
+                        return
                 for module in crossattn_modules:
-                        handle_parent = module.register_forward_hook(pag_pre_hook, with_kwargs=True)
-                        to_v = getattr(module, 'to_v', None)
-                        handle_to_v = to_v.register_forward_hook(to_v_pre_hook, with_kwargs=True)
+                        manager.install(module, PAG_HOOK_NAME, pag_attention_hook, passes=PassType.PERTURBED)
+                        manager.install(module.to_v, PAG_HOOK_NAME, pag_to_v_hook, owner=module, passes=PassType.PERTURBED)
+                manager.activate(PAG_HOOK_NAME, hook_context)
 
         def get_middle_block_modules(self):
                 """ Get all attention modules from the middle block 
@@ -357,13 +373,10 @@ class PAGExtensionScript(UIWrapper):
                 
                 """
                 try:
-                        m = shared.sd_model
-                        nlm = m.network_layer_mapping
-                        middle_block_modules = [m for m in nlm.values() if 'middle_block_1_transformer_blocks_0_attn1' in m.network_layer_name and 'CrossAttention' in m.__class__.__name__]
-                        return middle_block_modules
-                except AttributeError:
-                        logger.exception("AttributeError in get_middle_block_modules", stack_info=True)
-                        return []
+                        layer_index = get_layer_index()
+                        if layer_index is None:
+                                return []
+                        return layer_index.select(block='middle', attn='attn1', depth=0)
                 except Exception:
                         logger.exception("Exception in get_middle_block_modules", stack_info=True)
                         return []
@@ -372,66 +385,87 @@ class PAGExtensionScript(UIWrapper):
                 """ Get all cross attention modules """
                 return self.get_middle_block_modules()
 
-        def add_field_cross_attn_modules(self, module, field, value):
-                """ Add a field to a module if it doesn't exist """
-                if not hasattr(module, field):
-                        setattr(module, field, value)
-        
-        def remove_field_cross_attn_modules(self, module, field):
-                """ Remove a field from a module if it exists """
-                if hasattr(module, field):
-                        delattr(module, field)
-
         def on_cfg_denoiser_callback(self, params: CFGDenoiserParams, pag_params: PAGStateParams):
-                # always unhook
-                self.unhook_callbacks(pag_params)
-
                 pag_params.step = params.sampling_step
 
-                # patch combine_denoised
-                if pag_params.denoiser is None:
-                        pag_params.denoiser = params.denoiser
-                if getattr(params.denoiser, 'combine_denoised_patched', False) is False:
-                        try:
-                                setattr(params.denoiser, 'combine_denoised_original', params.denoiser.combine_denoised)
-                                # create patch that references the original function
-                                pass_conds_func = lambda *args, **kwargs: combine_denoised_pass_conds_list(
-                                        *args,
-                                        **kwargs,
-                                        original_func = params.denoiser.combine_denoised_original,
-                                        pag_params = pag_params)
-                                pag_params.patched_combine_denoised = patches.patch(__name__, params.denoiser, "combine_denoised", pass_conds_func)
-                                setattr(params.denoiser, 'combine_denoised_patched', True)
-                                setattr(params.denoiser, 'combine_denoised_original', patches.original(__name__, params.denoiser, "combine_denoised"))
-                        except KeyError:
-                                logger.exception("KeyError patching combine_denoised")
-                                pass
-                        except RuntimeError:
-                                logger.exception("RuntimeError patching combine_denoised")
-                                pass
+                # precompute the CFG schedule once per sampler pass, the hires pass uses a new denoiser
+                table_key = (id(params.denoiser), params.total_sampling_steps)
+                if pag_params.cfg_table_key != table_key:
+                        sigmas = get_sampler_sigmas(params.denoiser, params.total_sampling_steps)
+                        pag_params.cfg_table = build_cfg_schedule_table(pag_params, params.total_sampling_steps, sigmas)
+                        pag_params.cfg_table_key = table_key
+
+                # reset a fused batch that never reached on_cfg_denoised (e.g. interrupted)
+                if pag_params.pag_rows > 0:
+                        pag_params.hook_context.enable = False
+                        pag_params.hook_context.rows = slice(None)
+                        pag_params.pag_rows = 0
+
+                # the conds are set up after process_batch, read them from the denoiser of the running pass
+                pag_params.single_cond = has_single_unit_conds(getattr(params.denoiser, 'p', None))
+
+                # CFG scale is 1.0 outside the CFG interval, so the uncond prediction cancels out
+                # CFG-free PAG doesn't use the uncond prediction during PAG steps
+                skip_uncond = pag_params.single_cond and not cfg_interval_active(pag_params, params.sampling_step)
+                skip_uncond = skip_uncond or cfg_free_step(pag_params, params.sampling_step)
+                if skip_uncond and can_skip_uncond(params):
+                        self.skip_uncond_batch(params, pag_params)
 
                 # Run only within interval
-                if not pag_params.pag_start_step <= params.sampling_step <= pag_params.pag_end_step or pag_params.pag_scale <= 0:
+                if not pag_step_active(pag_params, params.sampling_step):
                         return
 
-                if isinstance(params.text_cond, dict):
-                        text_cond = params.text_cond['crossattn'] # SD XL
-                        pag_params.text_cond = {}
-                        pag_params.text_uncond = {}
-                        for key, value in params.text_cond.items():
-                                pag_params.text_cond[key] = value.clone().detach()
-                                pag_params.text_uncond[key] = value.clone().detach()
-                else:
-                        text_cond = params.text_cond # SD 1.5
-                        pag_params.text_cond = text_cond.clone().detach()
-                        pag_params.text_uncond = text_cond.clone().detach()
+                if pag_params.batch_mode == 'Fused' and can_fuse_batch(params):
+                        self.fuse_perturbed_batch(params, pag_params)
+                        return
 
-                pag_params.x_in = params.x.clone().detach()
-                pag_params.sigma = params.sigma.clone().detach()
-                pag_params.image_cond = params.image_cond.clone().detach()
-                pag_params.denoiser = params.denoiser
-                pag_params.make_condition_dict = get_make_condition_dict_fn(params.text_uncond)
+                self.capture_cond_inputs(params, pag_params)
+                if pag_params.activation_cache is not None:
+                        pag_params.activation_cache.capture(cond_batch_size(params.text_cond))
 
+        def capture_cond_inputs(self, params: CFGDenoiserParams, pag_params: PAGStateParams):
+                """ Keep references to the cond rows of the denoiser inputs for the perturbed forward, no copies
+                The denoiser doesn't modify them in place, so the perturbed forward sees the same inputs as the cond rows
+                """
+                cond_rows = cond_batch_size(params.text_cond)
+                pag_params.x_in = params.x[:cond_rows]
+                pag_params.sigma = params.sigma[:cond_rows]
+                pag_params.image_cond = params.image_cond[:cond_rows]
+                pag_params.text_cond = params.text_cond
+
+        def release_cond_inputs(self, pag_params: PAGStateParams):
+                """ Drop the references once the perturbed forward has consumed them """
+                pag_params.x_in = None
+                pag_params.sigma = None
+                pag_params.image_cond = None
+                pag_params.text_cond = None
+
+        def skip_uncond_batch(self, params: CFGDenoiserParams, pag_params: PAGStateParams):
+                """ Drop the uncond rows from the denoiser batch, the batch becomes [cond]
+                text_uncond is replaced with an empty slice of text_cond so the denoiser doesn't pad or split the batch
+                """
+                cond_rows = cond_batch_size(params.text_cond)
+                params.x = params.x[:cond_rows]
+                params.sigma = params.sigma[:cond_rows]
+                params.image_cond = params.image_cond[:cond_rows]
+                params.text_uncond = slice_conds_keep_type(params.text_cond, slice(0, 0))
+
+        def fuse_perturbed_batch(self, params: CFGDenoiserParams, pag_params: PAGStateParams):
+                """ Append a copy of the cond rows to the denoiser batch so the perturbed branch runs in the same forward
+                The batch becomes [cond, uncond, perturbed], and the text conditioning for the perturbed rows is appended to text_uncond
+                """
+                cond_rows = cond_batch_size(params.text_cond)
+                pag_params.pag_rows = cond_rows
+
+                params.x = torch.cat([params.x, params.x[:cond_rows]])
+                params.sigma = torch.cat([params.sigma, params.sigma[:cond_rows]])
+                params.image_cond = torch.cat([params.image_cond, params.image_cond[:cond_rows]])
+                params.text_uncond = catenate_conds_keep_type([params.text_uncond, params.text_cond])
+
+                # only the trailing perturbed rows of the batch get the PAG perturbation
+                pag_params.hook_context.rows = slice(-cond_rows, None)
+                pag_params.hook_context.enable = True
+                get_hook_manager().step_context.pass_type = PassType.DENOISE | PassType.PERTURBED
 
         def on_cfg_denoised_callback(self, params: CFGDenoisedParams, pag_params: PAGStateParams):
                 """ Callback function for the CFGDenoisedParams 
@@ -439,36 +473,70 @@ class PAGExtensionScript(UIWrapper):
                 
                 """
                 # Run only within interval
-                if not pag_params.pag_start_step <= params.sampling_step <= pag_params.pag_end_step or pag_params.pag_scale <= 0:
+                if not pag_step_active(pag_params, params.sampling_step):
+                        return
+
+                # perturbed branch was already evaluated in the main forward
+                if pag_params.pag_rows > 0:
+                        pag_params.hook_context.enable = False
+                        pag_params.hook_context.rows = slice(None)
+                        get_hook_manager().step_context.pass_type = PassType.DENOISE
+                        pag_params.pag_x_out = params.x[-pag_params.pag_rows:]
                         return
 
-                # passed from on_cfg_denoiser_callback
+                if pag_params.activation_cache is not None and pag_params.activation_cache.rows > 0:
+                        if pag_params.activation_cache.stop_capture():
+                                self.reuse_activations_forward(params, pag_params)
+                                return
+                        logger.warning("PAG input block activations were not captured, running the Separate forward for this step")
+
+                # passed from on_cfg_denoiser_callback, only the cond rows are used by combine_denoised
                 x_in = pag_params.x_in
                 tensor = pag_params.text_cond
-                uncond = pag_params.text_uncond
                 image_cond_in = pag_params.image_cond
                 sigma_in = pag_params.sigma
-                
-                # concatenate the conditions 
+                if x_in is None:
+                        logger.error("PAG inputs were not captured for this step")
+                        return
+
                 # "modules/sd_samplers_cfg_denoiser.py:237"
-                cond_in = catenate_conds([tensor, uncond])
-                make_condition_dict = get_make_condition_dict_fn(uncond)
-                conds = make_condition_dict(cond_in, image_cond_in)
+                make_condition_dict = get_make_condition_dict_fn(tensor)
+                conds = make_condition_dict(tensor, image_cond_in)
                 
-                # set pag_enable to True for the hooked cross attention modules
-                for module in pag_params.crossattn_modules:
-                        setattr(module, 'pag_enable', True)
+                # enable the perturbation in the hooked cross attention modules
+                pag_params.hook_context.enable = True
 
                 # get the PAG guidance (is there a way to optimize this so we don't have to calculate it twice?)
-                pag_x_out = params.inner_model(x_in, sigma_in, cond=conds)
+                # hooks of the other techniques skip the perturbed pass
+                with get_hook_manager().run_pass(PassType.PERTURBED):
+                        pag_x_out = params.inner_model(x_in, sigma_in, cond=conds)
 
                 # update pag_x_out
                 pag_params.pag_x_out = pag_x_out
 
-                # set pag_enable to False
-                for module in pag_params.crossattn_modules:
-                        setattr(module, 'pag_enable', False)
+                pag_params.hook_context.enable = False
+                self.release_cond_inputs(pag_params)
         
+        def reuse_activations_forward(self, params: CFGDenoisedParams, pag_params: PAGStateParams):
+                """ Run the perturbed branch for the cond rows only, skipping the UNet input blocks
+                PAG only perturbs the middle block, so the input block activations equal those of the cond pass that just ran
+                """
+                cache: UNetActivationCache = pag_params.activation_cache
+
+                text_cond = pag_params.text_cond
+                make_condition_dict = get_make_condition_dict_fn(text_cond)
+                conds = make_condition_dict(text_cond, pag_params.image_cond)
+
+                pag_params.hook_context.enable = True
+
+                try:
+                        with cache.replay(), get_hook_manager().run_pass(PassType.PERTURBED):
+                                pag_params.pag_x_out = params.inner_model(pag_params.x_in, pag_params.sigma, cond=conds)
+                finally:
+                        pag_params.hook_context.enable = False
+                        cache.release()
+                        self.release_cond_inputs(pag_params)
+
         def cfg_after_cfg_callback(self, params: AfterCFGCallbackParams, pag_params: PAGStateParams):
                 #self.unhook_callbacks(pag_params)
                 pass
@@ -480,69 +548,371 @@ class PAGExtensionScript(UIWrapper):
                         xyz_grid.AxisOption("[PAG] PAG Scale", float, pag_apply_field("pag_scale")),
                         xyz_grid.AxisOption("[PAG] PAG Start Step", int, pag_apply_field("pag_start_step")),
                         xyz_grid.AxisOption("[PAG] PAG End Step", int, pag_apply_field("pag_end_step")),
+                        xyz_grid.AxisOption("[PAG] CFG-Free", str, pag_apply_override('pag_cfg_free', boolean=True), choices=xyz_grid.boolean_choice(reverse=True)),
+                        xyz_grid.AxisOption("[PAG] Perturbation", str, pag_apply_override('pag_perturbation', boolean=False), choices=perturbation_names),
+                        xyz_grid.AxisOption("[PAG] Batch Mode", str, pag_apply_override('pag_batch_mode', boolean=False), choices=lambda: BATCH_MODES),
                         xyz_grid.AxisOption("[PAG] Enable CFG Scheduler", str, pag_apply_override('cfg_interval_enable', boolean=True), choices=xyz_grid.boolean_choice(reverse=True)),
                         xyz_grid.AxisOption("[PAG] CFG Noise Interval Low", float, pag_apply_field("cfg_interval_low")),
                         xyz_grid.AxisOption("[PAG] CFG Noise Interval High", float, pag_apply_field("cfg_interval_high")),
-                        xyz_grid.AxisOption("[PAG] CFG Schedule Type", str, pag_apply_override('cfg_interval_schedule', boolean=False), choices=lambda: SCHEDULES),
+                        xyz_grid.AxisOption("[PAG] CFG Schedule Type", str, pag_apply_override('cfg_interval_schedule', boolean=False), choices=schedule_names),
                         #xyz_grid.AxisOption("[PAG] ctnms_alpha", float, pag_apply_field("pag_ctnms_alpha")),
                 }
                 return extra_axis_options
 
 
 def combine_denoised_pass_conds_list(*args, **kwargs):
-        """ Hijacked function for combine_denoised in CFGDenoiser """
-        original_func = kwargs.get('original_func', None)
+        """ combine_denoised of CFGDenoiser with the CFG schedule and the PAG guidance, run by the guidance pipeline """
         new_params = kwargs.get('pag_params', None)
 
-        if new_params is None:
-                logger.error("new_params is None")
-                return original_func(*args)
-
         def new_combine_denoised(x_out, conds_list, uncond, cond_scale):
-                denoised_uncond = x_out[-uncond.shape[0]:]
-                denoised = torch.clone(denoised_uncond)
-
-                noise_level = calculate_noise_level(new_params.step, new_params.max_sampling_step)
-
-                # Calculate CFG Scale
-                cfg_scale = cond_scale
-                if new_params.cfg_interval_enable:
-                        if new_params.cfg_interval_schedule != 'Constant':
-                                # Calculate noise interval
-                                start = new_params.cfg_interval_low
-                                end = new_params.cfg_interval_high
-                                begin_range = start if start <= end else end
-                                end_range = end if start <= end else start
-                                # Scheduled CFG Value
-                                scheduled_cfg_scale = cfg_scheduler(new_params.cfg_interval_schedule, new_params.step, new_params.max_sampling_step, cond_scale)
-                                # Only apply CFG in the interval
-                                cfg_scale = scheduled_cfg_scale if begin_range <= noise_level <= end_range else 1.0
+                # strip the perturbed rows appended by the fused batch, layout is [cond, uncond, perturbed]
+                uncond_rows = uncond.shape[0]
+                if new_params.pag_rows > 0:
+                        x_out = x_out[:-new_params.pag_rows]
+                        uncond_rows -= new_params.pag_rows
+
+                plan = get_combine_plan(new_params, conds_list, x_out.device)
+
+                if uncond_rows == 0:
+                        # uncond was skipped, the cond prediction stands in for it like the denoiser's skip_uncond
+                        denoised_uncond = x_out.index_select(0, plan.first_cond_index)
+                else:
+                        denoised_uncond = x_out[-uncond_rows:]
+
+                # Scheduled CFG Value, only applied in the interval
+                cfg_table: CFGScheduleTable = new_params.cfg_table
+                cfg_scale = cfg_table.cfg_scale(new_params.step, cond_scale)
+
+                # PAG is the only guidance, the uncond stand-in cancels out at scale 1.0
+                if cfg_free_step(new_params, new_params.step):
+                        cfg_scale = 1.0
 
                 if incantations_debug:
-                        logger.debug(f"Schedule: {new_params.cfg_interval_schedule}, CFG Scale: {cfg_scale}, Noise_level: {round(noise_level,3)}")
+                        logger.debug(f"Schedule: {new_params.cfg_interval_schedule}, CFG Scale: {cfg_scale}, Noise_level: {round(cfg_table.noise_level(new_params.step),3)}")
+
+                # one row per (cond_index, weight) pair of conds_list
+                cond = x_out.index_select(0, plan.cond_index)
+                uncond_rows_per_cond = denoised_uncond if plan.one_cond_per_image else denoised_uncond.index_select(0, plan.image_index)
+                delta = (cond - uncond_rows_per_cond) * cfg_scale
+
+                # Apply PAG guidance only within interval
+                if pag_step_active(new_params, new_params.step):
+                        pag_x_out = new_params.pag_x_out
+                        if pag_x_out is None or pag_x_out.shape[0] < plan.batch_size:
+                                logger.error("Missing perturbed predictions in combine_denoised_pass_conds_list")
+                        else:
+                                pag_rows_per_cond = pag_x_out[:plan.batch_size] if plan.one_cond_per_image else pag_x_out.index_select(0, plan.image_index)
+                                delta += (cond - pag_rows_per_cond) * new_params.pag_scale
 
-                for i, conds in enumerate(conds_list):
-                        for cond_index, weight in conds:
-                                if not new_params.cfg_interval_enable:
-                                        denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cfg_scale)
-                                else:
-                                        denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cfg_scale)
+                delta *= plan.weights.to(delta.dtype).view(-1, *([1] * (delta.dim() - 1)))
 
-                                # Apply PAG guidance only within interval
-                                if not new_params.pag_start_step <= new_params.step <= new_params.pag_end_step or new_params.pag_scale <= 0:
-                                        continue
-                                else:
-                                        try:
-                                                denoised[i] += (x_out[cond_index] - new_params.pag_x_out[i]) * (weight * new_params.pag_scale)
-                                        except TypeError:
-                                                logger.exception("TypeError in combine_denoised_pass_conds_list")
-                                        except IndexError:
-                                                logger.exception("IndexError in combine_denoised_pass_conds_list")
-                                        #logger.debug(f"added PAG guidance to denoised - pag_scale:{global_scale}")
+                if plan.one_cond_per_image:
+                        denoised = denoised_uncond + delta
+                else:
+                        # sum the weighted contributions of the conds of each image
+                        denoised = denoised_uncond + torch.tensordot(plan.membership.to(delta.dtype), delta, dims=1)
                 return denoised
         return new_combine_denoised(*args)
 
 
+### Perturbations
+# A perturbation gets the attention output and the value projection of the perturbed rows, both [batch, tokens, dim],
+# and the latent (height, width) of the tokens or None if unknown. It returns the perturbed attention output.
+# Perturbations must keep the dtype of the activations and must not build [tokens, tokens] attention maps.
+
+
+def pag_to_v_hook(context: PAGHookContext, step_context: StepContext, module, kwargs, output):
+        """ Keep the output of the to_v module of an attention module, only on PAG forwards """
+        if not context.enable:
+                return
+        # the attention doesn't modify the value projection in place, so a reference is enough
+        context.last_to_v[module] = output.detach()
+
+
+def pag_attention_hook(context: PAGHookContext, step_context: StepContext, module, kwargs, output):
+        """ Apply the PAG perturbation to the output of an attention module """
+        if not context.enable:
+                return
+        # release the value projection, it is captured again on the next PAG forward
+        last_to_v = context.last_to_v.pop(module, None)
+        if last_to_v is None:
+                # this is bad
+                return output
+
+        # rows of the batch that belong to the perturbed branch, all rows unless fused
+        rows = context.rows
+        width, height = context.image_size
+        latent_size = latent_hw(width, height, last_to_v.shape[1])
+        new_output = context.perturbation(output[rows], last_to_v[rows], latent_size)
+        if rows == slice(None):
+                return new_output
+        output[rows] = new_output
+        return output
+
+
+def identity_perturbation(output: torch.Tensor, value: torch.Tensor, latent_size: Optional[tuple[int, int]]) -> torch.Tensor:
+        """ Identity self-attention map, the attention output is the value projection """
+        return value
+
+
+def blur_perturbation(output: torch.Tensor, value: torch.Tensor, latent_size: Optional[tuple[int, int]], kernel_size: int = 3, sigma: float = 1.0) -> torch.Tensor:
+        """ Gaussian blurred identity self-attention map, a separable depthwise blur of the value projection over the latent """
+        if latent_size is None:
+                return value
+        h, w = latent_size
+        batch_size, seq_len, inner_dim = value.shape
+        radius = kernel_size // 2
+        if h <= radius or w <= radius:
+                return value
+
+        x = torch.arange(kernel_size, device=value.device, dtype=torch.float32) - radius
+        kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+        kernel = (kernel / kernel.sum()).to(value.dtype)
+
+        v = value.transpose(1, 2).reshape(batch_size, inner_dim, h, w)
+        v = F.pad(v, (radius, radius, radius, radius), mode='reflect')
+        v = F.conv2d(v, kernel.view(1, 1, 1, kernel_size).expand(inner_dim, 1, 1, kernel_size), groups=inner_dim)
+        v = F.conv2d(v, kernel.view(1, 1, kernel_size, 1).expand(inner_dim, 1, kernel_size, 1), groups=inner_dim)
+        return v.reshape(batch_size, inner_dim, seq_len).transpose(1, 2)
+
+
+def masked_perturbation(output: torch.Tensor, value: torch.Tensor, latent_size: Optional[tuple[int, int]], stride: int = 2) -> torch.Tensor:
+        """ Identity self-attention map for every stride-th token, the other tokens keep their attention output """
+        output[:, ::stride] = value[:, ::stride]
+        return output
+
+
+PERTURBATION_REGISTRY: Dict[str, Callable] = {}
+
+
+def register_perturbation(name: str, perturbation_fn: Callable, **perturbation_params):
+        """
+        Register a PAG perturbation, its name is shown in the Perturbation dropdown.
+
+        Parameters:
+        name (str): Display name of the perturbation.
+        perturbation_fn (Callable): Function of (output, value, latent_size, **perturbation_params) returning the perturbed output.
+        perturbation_params: Parameters of the perturbation.
+        """
+        PERTURBATION_REGISTRY[name] = partial(perturbation_fn, **perturbation_params)
+
+
+def perturbation_names() -> list[str]:
+        return list(PERTURBATION_REGISTRY.keys())
+
+
+register_perturbation('Identity', identity_perturbation)
+register_perturbation('Blur (3x3)', blur_perturbation, kernel_size=3, sigma=1.0)
+register_perturbation('Blur (5x5)', blur_perturbation, kernel_size=5, sigma=2.0)
+register_perturbation('Masked (50%)', masked_perturbation, stride=2)
+
+
+def latent_hw(width: int, height: int, seq_len: int) -> Optional[tuple[int, int]]:
+        """ (height, width) of a token sequence of a UNet level, None if it doesn't match the image aspect ratio """
+        if width <= 0 or height <= 0 or seq_len <= 0:
+                return None
+        factor = math.isqrt((width * height) // seq_len)
+        if factor == 0:
+                return None
+        h, w = height // factor, width // factor
+        if h * w != seq_len:
+                return None
+        return h, w
+
+
+class CombinePlan:
+        """ Index and weight tensors of a conds_list, one entry per (cond_index, weight) pair """
+        def __init__(self, conds_list, device):
+                pairs = [(i, cond_index, weight) for i, conds in enumerate(conds_list) for cond_index, weight in conds]
+                self.batch_size = len(conds_list)
+                self.cond_index = torch.tensor([cond_index for _, cond_index, _ in pairs], dtype=torch.long, device=device)
+                self.image_index = torch.tensor([i for i, _, _ in pairs], dtype=torch.long, device=device)
+                self.weights = torch.tensor([weight for _, _, weight in pairs], dtype=torch.float32, device=device)
+                self.first_cond_index = torch.tensor([conds[0][0] for conds in conds_list], dtype=torch.long, device=device)
+                self.one_cond_per_image = len(pairs) == self.batch_size and all(i == image for image, (i, _, _) in enumerate(pairs))
+                # [batch_size, pairs] matrix that sums the pairs of each image
+                self.membership = F.one_hot(self.image_index, num_classes=self.batch_size).t().to(torch.float32)
+
+
+def get_combine_plan(pag_params: PAGStateParams, conds_list, device) -> CombinePlan:
+        """ conds_list is rebuilt every step with the same content, so build its plan once per job """
+        key = (tuple(tuple(conds) for conds in conds_list), device)
+        if pag_params.combine_plan is None or pag_params.combine_plan[0] != key:
+                pag_params.combine_plan = (key, CombinePlan(conds_list, device))
+        return pag_params.combine_plan[1]
+
+
+class UNetActivationCache:
+        """ Captures the outputs of the UNet input blocks for the first rows of a forward,
+        then replays them so a later forward over those rows starts at the middle block
+
+        The captured activations are those of the denoiser forward, including the edits of other techniques' hooks
+        on the input blocks, e.g. T2I-0 CTNMS. The Separate forward skips those hooks, so the two modes differ when both are on.
+        """
+        def __init__(self, unet):
+                self.unet = unet
+                self.rows = 0
+                self.activations = []
+                self.rows_seen = []
+                self.handles = []
+
+        def capture(self, rows: int):
+                """ Start capturing the first rows of the batch, the denoiser may run the batch in several chunks """
+                self.release()
+                self.rows = rows
+                self.activations = [[] for _ in self.unet.input_blocks]
+                self.rows_seen = [0 for _ in self.unet.input_blocks]
+                for idx, block in enumerate(self.unet.input_blocks):
+                        self.handles.append(block.register_forward_hook(self.capture_hook(idx)))
+
+        def capture_hook(self, idx: int):
+                def pag_capture_input_block(module, input, output):
+                        remaining = self.rows - self.rows_seen[idx]
+                        self.rows_seen[idx] += output.shape[0]
+                        if remaining <= 0:
+                                return
+                        # clone partial chunks so the uncond rows are not kept alive
+                        chunk = output if remaining >= output.shape[0] else output[:remaining].clone()
+                        self.activations[idx].append(chunk)
+                return pag_capture_input_block
+
+        def stop_capture(self) -> bool:
+                """ Stop capturing and join the captured chunks of each block
+                Returns False and releases the cache if a block didn't capture all rows, e.g. its forward didn't run
+                """
+                for handle in self.handles:
+                        handle.remove()
+                self.handles = []
+                if self.rows <= 0 or any(sum(chunk.shape[0] for chunk in chunks) != self.rows for chunks in self.activations):
+                        self.release()
+                        return False
+                self.activations = [chunks[0] if len(chunks) == 1 else torch.cat(chunks) for chunks in self.activations]
+                return True
+
+        @contextmanager
+        def replay(self):
+                """ Replace the forward of each input block with its captured activation, restoring any forward another extension set on the instance """
+                replaced = []
+                for block, activation in zip(self.unet.input_blocks, self.activations):
+                        replaced.append((block, block.__dict__.get('forward')))
+                        block.forward = lambda *args, activation=activation, **kwargs: activation
+                try:
+                        yield
+                finally:
+                        for block, forward in replaced:
+                                if forward is not None:
+                                        block.forward = forward
+                                else:
+                                        del block.forward
+
+        def release(self):
+                for handle in self.handles:
+                        handle.remove()
+                self.handles = []
+                self.activations = []
+                self.rows_seen = []
+                self.rows = 0
+
+
+def get_unet():
+        """ Get the UNet of the loaded model, None if there is none """
+        return getattr(getattr(shared.sd_model, 'model', None), 'diffusion_model', None)
+
+
+def pag_step_active(pag_params: PAGStateParams, step: int) -> bool:
+        """ Check if PAG guidance is applied at this step """
+        return pag_params.pag_start_step <= step <= pag_params.pag_end_step and pag_params.pag_scale > 0
+
+
+def cfg_free_step(pag_params: PAGStateParams, step: int) -> bool:
+        """ Check if PAG replaces CFG at this step """
+        return pag_params.cfg_free and pag_step_active(pag_params, step)
+
+
+def cfg_interval_active(pag_params: PAGStateParams, step: int) -> bool:
+        """ Check if CFG is applied at this step, False if the CFG scheduler sets the scale to 1.0 """
+        if pag_params.cfg_table is None:
+                return True
+        return pag_params.cfg_table.in_interval(step)
+
+
+def has_single_unit_conds(p: Optional[StableDiffusionProcessing]) -> bool:
+        """ Check if every image in the batch being sampled has one cond with weight 1 (no AND)
+        Then at CFG scale 1.0 the uncond prediction cancels out exactly
+        """
+        conds = getattr(p, 'c', None)
+        if getattr(p, 'is_hr_pass', False) and getattr(p, 'hr_c', None) is not None:
+                conds = p.hr_c
+        batch = getattr(conds, 'batch', None)
+        if batch is None:
+                return False
+        return all(len(conds) == 1 and conds[0].weight == 1.0 for conds in batch)
+
+
+def can_skip_uncond(params: CFGDenoiserParams) -> bool:
+        """ Check if the uncond rows can be dropped from the batch of the CFG denoiser """
+        if getattr(shared.opts, 's_min_uncond', 0) > 0:
+                # skip_uncond would drop the last rows of the cond batch instead
+                return False
+        if getattr(shared.opts, 'skip_early_cond', 0) > 0:
+                # skip_early_cond would trim the last rows of the cond batch, or leave it empty
+                return False
+        if shared.sd_model.cond_stage_key == "edit":
+                return False
+        return True
+
+
+def can_fuse_batch(params: CFGDenoiserParams) -> bool:
+        """ Check if the perturbed branch can be appended to the cond/uncond batch of the CFG denoiser
+        Falls back to a separate forward when the denoiser would split, pad or trim the batch
+        """
+        if not getattr(shared.opts, 'batch_cond_uncond', True):
+                return False
+        if getattr(shared.opts, 's_min_uncond', 0) > 0:
+                # skip_uncond drops the last rows of the batch
+                return False
+        if getattr(shared.opts, 'skip_early_cond', 0) > 0:
+                # skip_early_cond drops the last rows of the batch, the perturbed rows
+                return False
+        if shared.sd_model.cond_stage_key == "edit":
+                return False
+        if cond_batch_shape(params.text_cond)[1] != cond_batch_shape(params.text_uncond)[1]:
+                # cond and uncond would need padding
+                return False
+        return True
+
+
+def cond_batch_shape(cond):
+        """ Shape of the crossattn conditioning for SD 1.5 (tensor) and SD XL (dict) """
+        if isinstance(cond, dict):
+                return cond['crossattn'].shape
+        return cond.shape
+
+
+def cond_batch_size(cond) -> int:
+        return cond_batch_shape(cond)[0]
+
+
+def slice_conds_keep_type(cond, rows: slice):
+        """ Slice the rows of a cond, keeping the dict subclass of SD XL conds """
+        if not isinstance(cond, dict):
+                return cond[rows]
+        out = copy.copy(cond)
+        for key, value in cond.items():
+                out[key] = value[rows]
+        return out
+
+
+def catenate_conds_keep_type(conds):
+        """ catenate_conds that keeps the dict subclass of SD XL conds (DictWithShape), which the CFG denoiser reads .shape from """
+        if not isinstance(conds[0], dict):
+                return torch.cat(conds)
+        out = copy.copy(conds[0])
+        for key in conds[0].keys():
+                out[key] = torch.cat([c[key] for c in conds])
+        return out
+
+
 # from modules/sd_samplers_cfg_denoiser.py:187-195
 def get_make_condition_dict_fn(text_uncond):
         if shared.sd_model.model.conditioning_key == "crossattn-adm":
@@ -555,6 +925,89 @@ def get_make_condition_dict_fn(text_uncond):
         return make_condition_dict
 
 
+class CFGScheduleTable:
+        """ CFG scale and CFG interval mask of every sampling step of a sampler pass """
+        def __init__(self, schedule: Callable, max_steps: int, w0: float, scheduled: bool, cfg_scales: list[float], interval_mask: list[bool], noise_levels: list[float]):
+                self.schedule = schedule
+                self.max_steps = max_steps
+                self.w0 = w0
+                self.scheduled = scheduled # False if the CFG scale is the constant cond_scale
+                self.cfg_scales = cfg_scales
+                self.interval_mask = interval_mask
+                self.noise_levels = noise_levels
+
+        def index(self, step: int) -> int:
+                return min(max(step, 0), len(self.cfg_scales) - 1)
+
+        def in_interval(self, step: int) -> bool:
+                return self.interval_mask[self.index(step)]
+
+        def noise_level(self, step: int) -> float:
+                return self.noise_levels[self.index(step)]
+
+        def cfg_scale(self, step: int, cond_scale: float) -> float:
+                """ Scheduled CFG scale, 1.0 outside the interval """
+                if not self.scheduled:
+                        return cond_scale
+                i = self.index(step)
+                if not self.interval_mask[i]:
+                        return 1.0
+                if cond_scale == self.w0:
+                        return self.cfg_scales[i]
+                return self.schedule(i, self.max_steps, cond_scale)
+
+
+def build_cfg_schedule_table(pag_params: PAGStateParams, steps: int, sigmas: Optional[list[float]] = None) -> CFGScheduleTable:
+        """ Compute the CFG scale and interval mask of all sampling steps
+        Uses the sigmas of the sampler when known, otherwise the default noise levels of calculate_noise_level
+        """
+        max_steps = pag_params.max_sampling_step
+        w0 = pag_params.guidance_scale
+        schedule = SCHEDULE_REGISTRY.get(pag_params.cfg_interval_schedule, SCHEDULE_REGISTRY['Constant'])
+        scheduled = pag_params.cfg_interval_enable and pag_params.cfg_interval_schedule != 'Constant'
+
+        start = pag_params.cfg_interval_low
+        end = pag_params.cfg_interval_high
+        if sigmas is not None and len(sigmas) > steps:
+                # sampler sigmas are step aligned already
+                noise_levels = [float(sigma) for sigma in sigmas[:steps + 1]]
+        else:
+                # Refer to 3.1 Practice in the paper
+                # We want to round high and low noise levels to the nearest integer index
+                low_index = find_closest_index(start, max_steps)
+                high_index = find_closest_index(end, max_steps)
+                start = calculate_noise_level(low_index, max_steps)
+                end = calculate_noise_level(high_index, max_steps)
+                noise_levels = [calculate_noise_level(i, max_steps) for i in range(steps + 1)]
+        begin_range = start if start <= end else end
+        end_range = end if start <= end else start
+
+        interval_mask = [not scheduled or begin_range <= noise_level <= end_range for noise_level in noise_levels]
+        cfg_scales = [schedule(i, max_steps, w0) if scheduled else w0 for i in range(steps + 1)]
+
+        if pag_params.cfg_interval_enable:
+                logger.debug(f"Step Aligned CFG Interval: ({round(begin_range, 4)}, {round(end_range, 4)}), CFG steps: {[i for i, m in enumerate(interval_mask) if m]}")
+        return CFGScheduleTable(schedule, max_steps, w0, scheduled, cfg_scales, interval_mask, noise_levels)
+
+
+def get_sampler_sigmas(denoiser, steps: int) -> Optional[list[float]]:
+        """ Get the sigma schedule of the sampler running the denoiser, None if unknown
+        img2img and hires passes start partway into the schedule, so they keep the default noise levels
+        """
+        sampler = getattr(denoiser, 'sampler', None)
+        p = getattr(denoiser, 'p', None)
+        if p is None or not hasattr(sampler, 'get_sigmas'):
+                return None
+        if getattr(p, 'is_hr_pass', False) or getattr(p, 'init_images', None):
+                return None
+        try:
+                sigmas = sampler.get_sigmas(p, steps)
+        except Exception:
+                logger.exception("Error getting sampler sigmas, using default noise levels")
+                return None
+        return [float(sigma) for sigma in sigmas]
+
+
 def calculate_noise_level(i, N, sigma_min=0.002, sigma_max=80.0, rho=3):
     """
     Calculate the noise level for a given sampling step index.
@@ -620,63 +1073,6 @@ def find_closest_index(noise_level: float, N: int, sigma_min=0.002, sigma_max=80
 ### CFG Schedulers
 
 
-# TODO: Refactor this into something cleaner
-def cfg_scheduler(schedule: str, step: int, max_steps: int, w0: float) -> float:
-        """
-        Constant scheduler for CFG guidance weight.
-
-        Parameters:
-        step (int): Current sampling step.
-        max_steps (int): Total number of sampling steps.
-        w0 (float): Constant value for the guidance weight.
-
-        Returns:
-        float: Scheduled guidance weight value.
-        """
-        match schedule:
-                case 'Constant':
-                        return constant_schedule(step, max_steps, w0)
-                case 'Linear':
-                        return linear_schedule(step, max_steps, w0)
-                case 'Clamp-Linear (c=4.0)':
-                        return clamp_linear_schedule(step, max_steps, w0, 4.0)
-                case 'Clamp-Linear (c=2.0)':
-                        return clamp_linear_schedule(step, max_steps, w0, 2.0)
-                case 'Clamp-Linear (c=1.0)':
-                        return clamp_linear_schedule(step, max_steps, w0, 1.0)
-                case 'Inverse-Linear':
-                        return invlinear_schedule(step, max_steps, w0)
-                case 'PCS (s=0.01)':
-                        return powered_cosine_schedule(step, max_steps, w0, 0.01)
-                case 'PCS (s=0.1)':
-                        return powered_cosine_schedule(step, max_steps, w0, 0.1)
-                case 'PCS (s=1.0)':
-                        return powered_cosine_schedule(step, max_steps, w0, 1.0)
-                case 'PCS (s=2.0)':
-                        return powered_cosine_schedule(step, max_steps, w0, 2.0)
-                case 'PCS (s=4.0)':
-                        return powered_cosine_schedule(step, max_steps, w0, 4.0)
-                case 'Clamp-Cosine (c=4.0)':
-                        return clamp_cosine_schedule(step, max_steps, w0, 4.0)
-                case 'Clamp-Cosine (c=2.0)':
-                        return clamp_cosine_schedule(step, max_steps, w0, 2.0)
-                case 'Clamp-Cosine (c=1.0)':
-                        return clamp_cosine_schedule(step, max_steps, w0, 1.0)
-                case 'Cosine':
-                        return cosine_schedule(step, max_steps, w0)
-                case 'Sine':
-                        return sine_schedule(step, max_steps, w0)
-                case 'V-Shape':
-                        return v_shape_schedule(step, max_steps, w0)
-                case 'A-Shape':
-                        return a_shape_schedule(step, max_steps, w0)
-                case 'Interval':
-                        return interval_schedule(step, max_steps, w0, 0.25, 5.42)
-                case _:
-                        logger.error(f"Invalid CFG schedule: {schedule}")
-                        return constant_schedule(step, max_steps, w0)
-
-
 def constant_schedule(step: int, max_steps: int, w0: float):
         """
         Constant scheduler for CFG guidance weight.
@@ -763,6 +1159,47 @@ def interval_schedule(step: int, max_steps: int, w0: float, low: float, high: fl
         return 1.0
 
 
+# Schedule name -> callable(step, max_steps, w0) with the schedule parameters bound
+SCHEDULE_REGISTRY: Dict[str, Callable[[int, int, float], float]] = {}
+
+
+def register_schedule(name: str, schedule_fn: Callable, **schedule_params):
+        """
+        Register a CFG schedule, its name is shown in the CFG Schedule Type dropdown.
+
+        Parameters:
+        name (str): Display name of the schedule.
+        schedule_fn (Callable): Function of (step, max_steps, w0, **schedule_params) returning the guidance weight.
+        schedule_params: Parameters of the schedule, e.g. c=4.0 for clamp schedules.
+        """
+        SCHEDULE_REGISTRY[name] = partial(schedule_fn, **schedule_params)
+
+
+def schedule_names() -> list[str]:
+        return list(SCHEDULE_REGISTRY.keys())
+
+
+register_schedule('Constant', constant_schedule)
+register_schedule('Clamp-Linear (c=4.0)', clamp_linear_schedule, c=4.0)
+register_schedule('Clamp-Linear (c=2.0)', clamp_linear_schedule, c=2.0)
+register_schedule('Clamp-Linear (c=1.0)', clamp_linear_schedule, c=1.0)
+register_schedule('Linear', linear_schedule)
+register_schedule('Inverse-Linear', invlinear_schedule)
+register_schedule('Cosine', cosine_schedule)
+register_schedule('Clamp-Cosine (c=4.0)', clamp_cosine_schedule, c=4.0)
+register_schedule('Clamp-Cosine (c=2.0)', clamp_cosine_schedule, c=2.0)
+register_schedule('Clamp-Cosine (c=1.0)', clamp_cosine_schedule, c=1.0)
+register_schedule('Sine', sine_schedule)
+register_schedule('Interval', interval_schedule, low=0.25, high=5.42)
+register_schedule('PCS (s=0.01)', powered_cosine_schedule, s=0.01)
+register_schedule('PCS (s=0.1)', powered_cosine_schedule, s=0.1)
+register_schedule('PCS (s=1.0)', powered_cosine_schedule, s=1.0)
+register_schedule('PCS (s=2.0)', powered_cosine_schedule, s=2.0)
+register_schedule('PCS (s=4.0)', powered_cosine_schedule, s=4.0)
+register_schedule('V-Shape', v_shape_schedule)
+register_schedule('A-Shape', a_shape_schedule)
+
+
 
 # XYZ Plot
 # Based on @mcmonkey4eva's XYZ Plot implementation here: https://github.com/mcmonkeyprojects/sd-dynamic-thresholding/blob/master/scripts/dynamic_thresholding.py
@@ -784,56 +1221,3 @@ def pag_apply_field(field):
                 setattr(p, "pag_active", True)
         setattr(p, field, x)
     return fun
-
-
-# thanks torch; removing hooks DOESN'T WORK
-# thank you to @ProGamerGov for this https://github.com/pytorch/pytorch/issues/70455
-def _remove_all_forward_hooks(
-    module: torch.nn.Module, hook_fn_name: Optional[str] = None
-) -> None:
-    """
-    This function removes all forward hooks in the specified module, without requiring
-    any hook handles. This lets us clean up & remove any hooks that weren't property
-    deleted.
-
-    Warning: Various PyTorch modules and systems make use of hooks, and thus extreme
-    caution should be exercised when removing all hooks. Users are recommended to give
-    their hook function a unique name that can be used to safely identify and remove
-    the target forward hooks.
-
-    Args:
-
-        module (nn.Module): The module instance to remove forward hooks from.
-        hook_fn_name (str, optional): Optionally only remove specific forward hooks
-            based on their function's __name__ attribute.
-            Default: None
-    """
-
-    if hook_fn_name is None:
-        warn("Removing all active hooks can break some PyTorch modules & systems.")
-
-
-    def _remove_hooks(m: torch.nn.Module, name: Optional[str] = None) -> None:
-        if hasattr(module, "_forward_hooks"):
-            if m._forward_hooks != OrderedDict():
-                if name is not None:
-                    dict_items = list(m._forward_hooks.items())
-                    m._forward_hooks = OrderedDict(
-                        [(i, fn) for i, fn in dict_items if fn.__name__ != name]
-                    )
-                else:
-                    m._forward_hooks: Dict[int, Callable] = OrderedDict()
-
-    def _remove_child_hooks(
-        target_module: torch.nn.Module, hook_name: Optional[str] = None
-    ) -> None:
-        for name, child in target_module._modules.items():
-            if child is not None:
-                _remove_hooks(child, hook_name)
-                _remove_child_hooks(child, hook_name)
-
-    # Remove hooks from target submodules
-    _remove_child_hooks(module, hook_fn_name)
-
-    # Remove hooks from the target module
-    _remove_hooks(module, hook_fn_name)
\ No newline at end of file
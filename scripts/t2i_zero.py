@@ -3,10 +3,12 @@ from os import environ
 import modules.scripts as scripts
 import gradio as gr
 
-from functools import reduce
+from functools import lru_cache, reduce
 
 from scripts.incant_utils import plot_tools
-from einops import rearrange
+from scripts.incant_utils.layer_index import get_layer_index
+from scripts.incant_utils.hook_manager import PassType, get_hook_manager
+from scripts.incant_utils.ctnms import CTNMS_MASK_MODES, CTNMS_MASK_REFRESH_MODES, CTNMS_EMA_STORAGE_MODES, T2I0HookContext, t2i0_to_v_hook, cross_token_non_maximum_suppression
 
 
 from scripts.ui_wrapper import UIWrapper
@@ -16,16 +18,8 @@ from modules import prompt_parser
 from modules import sd_hijack
 from modules.script_callbacks import CFGDenoiserParams
 from modules.processing import StableDiffusionProcessing
-from modules import shared
 
-import math
 import torch
-from torch.nn import functional as F
-from torchvision.transforms import GaussianBlur
-
-from warnings import warn
-from typing import Callable, Dict, Optional
-from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 logger.setLevel(environ.get("SD_WEBUI_LOG_LEVEL", logging.INFO))
@@ -72,6 +66,13 @@ class T2I0StateParams:
                 self.token_count: int = 0
                 self.tokens: list[int] = [] # [0, 20]
                 self.window_size_period: int = 10 # [0, 20]
+                self.ctnms_mask_mode: str = 'Per Layer'
+                self.ctnms_mask_refresh: str = 'Stride'
+                self.ctnms_mask_stride: int = 1 # recompute the token masks every this many steps
+                self.ctnms_mask_drift: float = 0.1 # relative change of the attention output that refreshes the token masks in Adaptive mode
+                self.ctnms_ema_storage: str = 'Full'
+                self.ctnms_ema_budget: float = 0 # MB of EMA buffers, 0 is unlimited
+                self.ctnms_tile_size: int = 0 # latent pixels per CTNMS tile, 0 is untiled
                 self.ctnms_alpha: float = 0.05 # [0., 1.] if abs value of difference between uncodition and concept-conditioned is less than this, then zero out the concept-conditioned values less than this
                 self.correction_threshold: float = 0.5 # [0., 1.]
                 self.correction_strength: float = 0.25 # [0., 1.) # larger bm is less volatile changes in momentum
@@ -80,11 +81,40 @@ class T2I0StateParams:
                 self.height = None
                 self.dims = []
                 self.cbs_similarities: list = None # we can precompute this?
+                self.cbs_cache = CbSCache() # corrected conditioning of this job
+
+
+# name of the T2I-0 hooks in the HookManager
+T2I0_HOOK_NAME = 't2i0'
+
+
+class CbSCache:
+        """ Corrected conditioning of the Correction by Similarities, reused while the cond and the CbS parameters stay the same
+        The denoiser rebuilds the cond tensor every step, so entries are matched by content instead of identity.
+        A new prompt schedule segment doesn't match and gets its own entry.
+        """
+        def __init__(self, max_entries: int = 8):
+                self.max_entries = max_entries
+                self.entries = [] # (key, cond, corrected cond)
+
+        def get(self, key: tuple, cond: torch.Tensor):
+                for entry_key, entry_cond, corrected in self.entries:
+                        if entry_key == key and entry_cond.shape == cond.shape and entry_cond.dtype == cond.dtype and entry_cond.device == cond.device and torch.equal(entry_cond, cond):
+                                return corrected
+                return None
+
+        def put(self, key: tuple, cond: torch.Tensor, corrected: torch.Tensor):
+                # cond is corrected in place afterwards, keep a copy of the uncorrected values
+                self.entries.append((key, cond.detach().clone(), corrected))
+                if len(self.entries) > self.max_entries:
+                        self.entries.pop(0)
+
 
 class T2I0ExtensionScript(UIWrapper):
         def __init__(self):
                 self.cached_c = [None, None]
                 self.handles = []
+                self.t2i0_params = None # list[T2I0StateParams] of the current job
 
         # Extension title in menu UI
         def title(self) -> str:
@@ -110,6 +140,34 @@ class T2I0ExtensionScript(UIWrapper):
                                 attnreg = gr.Checkbox(visible=False, value=False, default=False, label="Use Attention Regulation", elem_id='t2i0_use_attnreg')
                                 ctnms_alpha = gr.Slider(value = 0.1, minimum = 0.0, maximum = 1.0, step = 0.01, label="Alpha for Cross-Token Non-Maximum Suppression", elem_id = 't2i0_ctnms_alpha', info="Contribution of the suppressed attention map, default 0.1")
                                 ema_factor = gr.Slider(value=0.0, minimum=0.0, maximum=4.0, default=2.0, label="EMA Smoothing Factor", elem_id='t2i0_ema_factor', info="Based on method from [arXiv:2403.06381]")
+                        with gr.Row():
+                                ctnms_mask_mode = gr.Dropdown(
+                                        value='Per Layer',
+                                        choices=CTNMS_MASK_MODES,
+                                        label="CTNMS Mask",
+                                        elem_id='t2i0_ctnms_mask_mode',
+                                        info="Per Layer computes the suppression mask in every cross attention layer. Shared computes it once per forward in the first layer and resamples it for the other layers (faster).",
+                                )
+                                ctnms_mask_refresh = gr.Dropdown(
+                                        value='Stride',
+                                        choices=CTNMS_MASK_REFRESH_MODES,
+                                        label="CTNMS Mask Refresh",
+                                        elem_id='t2i0_ctnms_mask_refresh',
+                                        info="Stride recomputes the suppression mask every N steps. Adaptive recomputes it when the attention output drifts past the threshold.",
+                                )
+                        with gr.Row():
+                                ctnms_mask_stride = gr.Slider(value=1, minimum=1, maximum=20, step=1, label="CTNMS Mask Stride", elem_id='t2i0_ctnms_mask_stride', info="Recompute the suppression mask every this many steps, 1 is every step")
+                                ctnms_mask_drift = gr.Slider(value=0.1, minimum=0.0, maximum=1.0, step=0.01, label="CTNMS Mask Drift Threshold", elem_id='t2i0_ctnms_mask_drift', info="Adaptive refresh: relative change of the attention output that recomputes the mask")
+                        with gr.Row():
+                                ctnms_ema_storage = gr.Dropdown(
+                                        value='Full',
+                                        choices=CTNMS_EMA_STORAGE_MODES,
+                                        label="CTNMS EMA Storage",
+                                        elem_id='t2i0_ctnms_ema_storage',
+                                        info="Half Precision stores the EMA in 16-bit floats, Downsampled at half the resolution of each layer.",
+                                )
+                                ctnms_ema_budget = gr.Slider(value=0, minimum=0, maximum=8192, step=64, label="CTNMS EMA Budget (MB)", elem_id='t2i0_ctnms_ema_budget', info="Layers whose EMA doesn't fit the budget are not smoothed, 0 is unlimited")
+                                ctnms_tile_size = gr.Slider(value=0, minimum=0, maximum=65536, step=256, label="CTNMS Tile Size", elem_id='t2i0_ctnms_tile_size', info="Process CTNMS in tiles of about this many latent pixels to bound its memory at high resolutions, 0 is off")
                 active.do_not_save_to_config = True
                 attnreg.do_not_save_to_config = True
                 step_start.do_not_save_to_config = True
@@ -121,6 +179,13 @@ class T2I0ExtensionScript(UIWrapper):
                 ctnms_alpha.do_not_save_to_config = True
                 ema_factor.do_not_save_to_config = True
                 tokens.do_not_save_to_config = True
+                ctnms_mask_mode.do_not_save_to_config = True
+                ctnms_mask_refresh.do_not_save_to_config = True
+                ctnms_mask_stride.do_not_save_to_config = True
+                ctnms_mask_drift.do_not_save_to_config = True
+                ctnms_ema_storage.do_not_save_to_config = True
+                ctnms_ema_budget.do_not_save_to_config = True
+                ctnms_tile_size.do_not_save_to_config = True
                 self.infotext_fields = [
                         (active, lambda d: gr.Checkbox.update(value='T2I-0 Active' in d)),
                         #(attnreg, lambda d: gr.Checkbox.update(value='T2I-0 AttnReg' in d)),
@@ -132,6 +197,13 @@ class T2I0ExtensionScript(UIWrapper):
                         (ctnms_alpha, 'T2I-0 CTNMS Alpha'),
                         (ema_factor, 'T2I-0 CTNMS EMA Smoothing Factor'),
                         (tokens, 'T2I-0 Tokens'),
+                        (ctnms_mask_mode, 'T2I-0 CTNMS Mask'),
+                        (ctnms_mask_refresh, 'T2I-0 CTNMS Mask Refresh'),
+                        (ctnms_mask_stride, 'T2I-0 CTNMS Mask Stride'),
+                        (ctnms_mask_drift, 'T2I-0 CTNMS Mask Drift Threshold'),
+                        (ctnms_ema_storage, 'T2I-0 CTNMS EMA Storage'),
+                        (ctnms_ema_budget, 'T2I-0 CTNMS EMA Budget'),
+                        (ctnms_tile_size, 'T2I-0 CTNMS Tile Size'),
                 ]
                 self.paste_field_names = [
                         't2i0_active',
@@ -143,19 +215,28 @@ class T2I0ExtensionScript(UIWrapper):
                         't2i0_ema_factor',
                         't2i0_step_start',
                         't2i0_step_end',
-                        't2i0_tokens'
+                        't2i0_tokens',
+                        't2i0_ctnms_mask_mode',
+                        't2i0_ctnms_mask_refresh',
+                        't2i0_ctnms_mask_stride',
+                        't2i0_ctnms_mask_drift',
+                        't2i0_ctnms_ema_storage',
+                        't2i0_ctnms_ema_budget',
+                        't2i0_ctnms_tile_size',
                 ]
-                return [active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start]
+                return [active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start, ctnms_mask_mode, ctnms_mask_refresh, ctnms_mask_stride, ctnms_mask_drift, ctnms_ema_storage, ctnms_ema_budget, ctnms_tile_size]
 
         def process_batch(self, p: StableDiffusionProcessing, *args, **kwargs):
                self.t2i0_process_batch(p, *args, **kwargs)
 
-        def t2i0_process_batch(self, p: StableDiffusionProcessing, active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start, *args, **kwargs):
+        def t2i0_process_batch(self, p: StableDiffusionProcessing, active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start, ctnms_mask_mode, ctnms_mask_refresh, ctnms_mask_stride, ctnms_mask_drift, ctnms_ema_storage, ctnms_ema_budget, ctnms_tile_size, *args, **kwargs):
                 active = getattr(p, "t2i0_active", active)
                 # use_attnreg = getattr(p, "t2i0_attnreg", attnreg)
                 ema_factor = getattr(p, "t2i0_ema_factor", ema_factor)
                 step_start = getattr(p, "t2i0_step_start", step_start)
                 step_end = getattr(p, "t2i0_step_end", step_end)
+                # deactivate the hooks of the previous job
+                self.unhook_callbacks()
                 if active is False:
                         return
                 window_size = getattr(p, "t2i0_window_size", window_size)
@@ -163,6 +244,13 @@ class T2I0ExtensionScript(UIWrapper):
                 correction_threshold = getattr(p, "t2i0_correction_threshold", correction_threshold)
                 correction_strength = getattr(p, "t2i0_correction_strength", correction_strength)
                 tokens = getattr(p, "t2i0_tokens", tokens)
+                ctnms_mask_mode = getattr(p, "t2i0_ctnms_mask_mode", ctnms_mask_mode)
+                ctnms_mask_refresh = getattr(p, "t2i0_ctnms_mask_refresh", ctnms_mask_refresh)
+                ctnms_mask_stride = getattr(p, "t2i0_ctnms_mask_stride", ctnms_mask_stride)
+                ctnms_mask_drift = getattr(p, "t2i0_ctnms_mask_drift", ctnms_mask_drift)
+                ctnms_ema_storage = getattr(p, "t2i0_ctnms_ema_storage", ctnms_ema_storage)
+                ctnms_ema_budget = getattr(p, "t2i0_ctnms_ema_budget", ctnms_ema_budget)
+                ctnms_tile_size = getattr(p, "t2i0_ctnms_tile_size", ctnms_tile_size)
                 p.extra_generation_params.update({
                         "T2I-0 Active": active,
                         #"T2I-0 AttnReg": attnreg,
@@ -174,9 +262,16 @@ class T2I0ExtensionScript(UIWrapper):
                         "T2I-0 CTNMS Alpha": ctnms_alpha,
                         "T2I-0 CTNMS EMA Smoothing Factor": ema_factor,
                         "T2I-0 Tokens": tokens,
+                        "T2I-0 CTNMS Mask": ctnms_mask_mode,
+                        "T2I-0 CTNMS Mask Refresh": ctnms_mask_refresh,
+                        "T2I-0 CTNMS Mask Stride": ctnms_mask_stride,
+                        "T2I-0 CTNMS Mask Drift Threshold": ctnms_mask_drift,
+                        "T2I-0 CTNMS EMA Storage": ctnms_ema_storage,
+                        "T2I-0 CTNMS EMA Budget": ctnms_ema_budget,
+                        "T2I-0 CTNMS Tile Size": ctnms_tile_size,
                 })
 
-                self.create_hook(p, active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start, p.width, p.height)
+                self.create_hook(p, active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start, p.width, p.height, ctnms_mask_mode, ctnms_mask_refresh, ctnms_mask_stride, ctnms_mask_drift, ctnms_ema_storage, ctnms_ema_budget, ctnms_tile_size)
 
         def parse_concept_prompt(self, prompt:str) -> list[str]:
                 """
@@ -194,7 +289,7 @@ class T2I0ExtensionScript(UIWrapper):
                         return []
                 return [x.strip() for x in prompt.split(",")]
 
-        def create_hook(self, p, active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start, width, height, *args, **kwargs):
+        def create_hook(self, p, active, attnreg, window_size, ctnms_alpha, correction_threshold, correction_strength, tokens, ema_factor, step_end, step_start, width, height, ctnms_mask_mode='Per Layer', ctnms_mask_refresh='Stride', ctnms_mask_stride=1, ctnms_mask_drift=0.1, ctnms_ema_storage='Full', ctnms_ema_budget=0, ctnms_tile_size=0, *args, **kwargs):
                 # Sanity check
                 cross_attn_modules = self.get_cross_attn_modules()
                 if len(cross_attn_modules) == 0:
@@ -222,6 +317,13 @@ class T2I0ExtensionScript(UIWrapper):
                 params.step_end = step_end
                 params.window_size_period = window_size
                 params.ctnms_alpha = ctnms_alpha
+                params.ctnms_mask_mode = ctnms_mask_mode
+                params.ctnms_mask_refresh = ctnms_mask_refresh
+                params.ctnms_mask_stride = ctnms_mask_stride
+                params.ctnms_mask_drift = ctnms_mask_drift
+                params.ctnms_ema_storage = ctnms_ema_storage
+                params.ctnms_ema_budget = ctnms_ema_budget
+                params.ctnms_tile_size = ctnms_tile_size
                 params.correction_threshold = correction_threshold
                 params.correction_strength = correction_strength
                 params.strength = 1.0
@@ -237,50 +339,44 @@ class T2I0ExtensionScript(UIWrapper):
 
 
 
-                # Use lambda to call the callback function with the parameters to avoid global variables
-                y = lambda params: self.on_cfg_denoiser_callback(params, t2i0_params)
-                # un = lambda params: self.unhook_callbacks()
-
                 # Hook callbacks
                 if ctnms_alpha > 0:
-                        self.ready_hijack_forward(ctnms_alpha, width, height, ema_factor, step_start, step_end, token_indices, params.token_count)
+                        self.ready_hijack_forward(ctnms_alpha, width, height, ema_factor, step_start, step_end, token_indices, params.token_count, ctnms_mask_mode, ctnms_mask_refresh, ctnms_mask_stride, ctnms_mask_drift, ctnms_ema_storage, ctnms_ema_budget, ctnms_tile_size)
 
+                self.t2i0_params = t2i0_params
                 logger.debug('Hooked callbacks')
-                script_callbacks.on_cfg_denoiser(y)
                 script_callbacks.on_script_unloaded(self.unhook_callbacks)
 
         def postprocess_batch(self, p, *args, **kwargs):
                 self.t2i0_postprocess_batch(p, *args, **kwargs)
 
         def t2i0_postprocess_batch(self, p, active, *args, **kwargs):
+                manager = get_hook_manager()
+                t2i0_context = manager.context(T2I0_HOOK_NAME) if manager is not None else None
+                if t2i0_context is not None and len(t2i0_context.ema.buffers) > 0:
+                        logger.info(t2i0_context.ema.report())
                 self.unhook_callbacks()
                 active = getattr(p, "t2i0_active", active)
                 if active is False:
                         return
 
-        def unhook_callbacks(self):
-                global handles
+        def unhook_callbacks(self, *args, **kwargs):
+                """ Deactivate the T2I-0 hooks, they stay installed on the model """
                 logger.debug('Unhooked callbacks')
-                cross_attn_modules = self.get_cross_attn_modules()
-                for module in cross_attn_modules:
-                        self.remove_field_cross_attn_modules(module, 't2i0_last_attn_map')
-                        self.remove_field_cross_attn_modules(module, 't2i0_step')
-                        self.remove_field_cross_attn_modules(module, 't2i0_step_start')
-                        self.remove_field_cross_attn_modules(module, 't2i0_step_end')
-                        self.remove_field_cross_attn_modules(module, 't2i0_ema_factor')
-                        self.remove_field_cross_attn_modules(module, 't2i0_ema')
-                        self.remove_field_cross_attn_modules(module, 'plot_num')
-                        self.remove_field_cross_attn_modules(module, 't2i0_tokens')
-                        self.remove_field_cross_attn_modules(module, 't2i0_token_count')
-                        self.remove_field_cross_attn_modules(module, 't2i0_to_v_map')
-                        self.remove_field_cross_attn_modules(module.to_k, 't2i0_parent_module')
-                        self.remove_field_cross_attn_modules(module.to_v, 't2i0_parent_module')
-                        _remove_all_forward_hooks(module, 'cross_token_non_maximum_suppression')
-                        # _remove_all_forward_hooks(module, 'cross_token_non_maximum_suppression_pre')
-                        # _remove_all_forward_hooks(module.to_k, 't2i0_to_k_hook')
-                        _remove_all_forward_hooks(module.to_v, 't2i0_to_v_hook')
+                manager = get_hook_manager()
+                if manager is not None:
+                        manager.deactivate(T2I0_HOOK_NAME)
+                self.t2i0_params = None
                 script_callbacks.remove_current_script_callbacks()
 
+        # T2I-0 stage: applies the CbS correction to the text cond within the step window
+        def guidance_active(self) -> bool:
+                return self.t2i0_params is not None
+
+        def on_cfg_denoiser(self, params: CFGDenoiserParams):
+                if self.t2i0_params is not None:
+                        self.on_cfg_denoiser_callback(params, self.t2i0_params)
+
         def apply_attnreg(self, f, C, alpha, B, *args, **kwargs):
                 """
                 Apply attention regulation on an embedding.
@@ -306,9 +402,10 @@ class T2I0ExtensionScript(UIWrapper):
         def correction_by_similarities(self, f, C, percentile, gamma, alpha, tokens=None, token_count=77):
                 """
                 Apply the Correction by Similarities algorithm on embeddings.
+                All selected tokens of all batch items are corrected at once, every correction only reads the uncorrected embeddings.
 
                 Args:
-                f (Tensor): The embedding tensor of shape (n, d).
+                f (Tensor): The embedding tensor of shape (n, d) or (batch, n, d).
                 C (list): Indices of selected tokens.
                 percentile (float): Percentile to use for score threshold.
                 gamma (int): Window size for the windowing function.
@@ -321,72 +418,58 @@ class T2I0ExtensionScript(UIWrapper):
                 if alpha == 0:
                         return f
 
-                n, d = f.shape
+                unbatched = f.dim() == 2
+                if unbatched:
+                        f = f.unsqueeze(0)
+                batch_size, n, d = f.shape
 
                 token_indices = tokens
                 min_idx = 1
                 max_idx = min(token_count+1, n)
-                if token_indices is None:
-                        token_indices = list(range(min_idx, max_idx))
-                if token_indices == []:
+                if token_indices is None or token_indices == []:
                         token_indices = list(range(min_idx, max_idx))
                 else:
                         token_indices = [x+1 for x in token_indices if x >= 0 and x < n]
-
+                token_indices = [c for c in token_indices if c >= 0 and c < n]
+                if len(token_indices) == 0:
+                        return f.squeeze(0) if unbatched else f
+
+                # calculate score threshold to filter out values under score threshold
+                # often there is a huge difference between the max and min values, so we use a log-like function instead
+                k = 10
+                e= 2.718281
+                pct_max = 1/(1+1e-10)
+                pct_min = 1e-16
+                # max of 0.999... to 0.0000...1
+                pct = min(pct_max, max(pct_min, 1 - e**(-k * percentile)))
 
                 f_tilde = f.detach().clone()  # Copy the embedding tensor
-
-                # Define a windowing function
-                def psi(c, gamma, n, dtype, device, min_idx, max_idx):
-                        window = torch.zeros(n, dtype=dtype, device=device)
-                        start = max(min_idx, c - gamma)
-                        end = min(max_idx, c + gamma + 1)
-                        window[start:end] = 1
-                        return window
-
-                def threshold_filter(t, tau):
-                       """ Threshold filter function
-                       Filters product values below a threshold tau and normalizes them to leave only the most similar dimensions.
-                        Arguments:
-                                t: torch.Tensor - The tensor to threshold
-                                tau: float - The threshold value
-                        Returns:
-                                bool: True if the value is above the threshold, False otherwise
-                       """
-                       pass
-
-
-
-
-                for c in token_indices:
-                        if c < 0 or c >= n:
-                                continue
-                        Sc = f[c] * f  # Element-wise multiplication
-
-                        # calculate score threshold to filter out values under score threshold
-                        # often there is a huge difference between the max and min values, so we use a log-like function instead
-                        k = 10
-                        e= 2.718281
-                        pct_max = 1/(1+1e-10)
-                        pct_min = 1e-16
-                        # max of 0.999... to 0.0000...1
-                        pct = min(pct_max, max(pct_min, 1 - e**(-k * percentile)))
-
-                        tau = torch.quantile(Sc, pct)
-
+                f_float = f.detach().float()
+                selected = torch.tensor(token_indices, device=f.device)
+                window = cbs_window_matrix(n, gamma, min_idx, max_idx, f.device).index_select(0, selected)  # [tokens, n]
+
+                # [batch, tokens, n, d] products, chunked over the tokens to bound memory and the size limit of torch.quantile
+                chunk_size = max(1, CBS_CHUNK_ELEMENTS // (batch_size * n * d))
+                for chunk_start in range(0, len(token_indices), chunk_size):
+                        chunk = selected[chunk_start:chunk_start + chunk_size]
+                        f_c = f_float.index_select(1, chunk)
+                        Sc = f_c.unsqueeze(2) * f_float.unsqueeze(1)  # Element-wise multiplication
+
+                        Sc = Sc.flatten(2)
+                        tau = torch.quantile(Sc, pct, dim=-1, keepdim=True)
                         Sc_tilde = Sc * (Sc > tau)  # Apply threshold and filter
-                        Sc_tilde /= Sc_tilde.max()  # Normalize
+                        Sc_tilde /= Sc_tilde.amax(dim=-1, keepdim=True)  # Normalize
+                        Sc_tilde = Sc_tilde.view(batch_size, -1, n, d)
 
-                        window = psi(c, gamma, n, Sc_tilde.dtype, Sc_tilde.device, min_idx, max_idx).unsqueeze(1)  # Apply windowing function
+                        # Apply windowing function and combine embeddings
+                        f_c_tilde = torch.einsum('bknd,kn,bnd->bkd', Sc_tilde, window[chunk_start:chunk_start + chunk_size], f_float)
+                        f_tilde[:, chunk] = ((1 - alpha) * f_c + alpha * f_c_tilde).to(f_tilde.dtype)  # Blend embeddings
 
-                        Sc_tilde *= window
-                        f_c_tilde = torch.sum(Sc_tilde * f, dim=0)  # Combine embeddings
-                        f_tilde[c] = (1 - alpha) * f[c] + alpha * f_c_tilde  # Blend embeddings
+                return f_tilde.squeeze(0) if unbatched else f_tilde
 
-                return f_tilde
-
-        def ready_hijack_forward(self, alpha, width, height, ema_factor, step_start, step_end, tokens, token_count):
-                """ Create a hook to modify the output of the forward pass of the cross attention module
+        def ready_hijack_forward(self, alpha, width, height, ema_factor, step_start, step_end, tokens, token_count, mask_mode='Per Layer', mask_refresh='Stride', mask_stride=1, mask_drift=0.1, ema_storage='Full', ema_budget=0, tile_size=0):
+                """ Install the hooks that modify the output of the forward pass of the cross attention modules and activate them for this job
+                The hooks are only installed the first time, later jobs swap in their own context
                 Arguments:
                         alpha: float - The strength of the CTNMS correction, default 0.1
                         width: int - The width of the final output image map
@@ -396,6 +479,13 @@ class T2I0ExtensionScript(UIWrapper):
                         step_end: int - The number of steps to apply the CTNMS correction, after which don't
                         tokens: list[int] - List of token indices to condition on
                         token_count: int - The number of tokens in the prompt
+                        mask_mode: str - 'Per Layer' or 'Shared', see CTNMS_MASK_MODES
+                        mask_refresh: str - 'Stride' or 'Adaptive', see CTNMS_MASK_REFRESH_MODES
+                        mask_stride: int - Recompute the token masks every this many steps
+                        mask_drift: float - Relative drift of the attention output that recomputes the token masks in Adaptive mode
+                        ema_storage: str - How the EMA buffers are stored, see CTNMS_EMA_STORAGE_MODES
+                        ema_budget: float - Memory budget of the EMA buffers in MB, 0 is unlimited
+                        tile_size: int - Latent pixels per CTNMS tile, 0 runs CTNMS on the whole layer at once
 
                 Only modifies the output of the cross attention modules that get context (i.e. text embedding)
                 """
@@ -403,164 +493,27 @@ class T2I0ExtensionScript(UIWrapper):
                 if len(cross_attn_modules) == 0:
                         logger.error("No cross attention modules found, cannot run T2I-0")
                         return
-                # add field for last_attn_map
-                plot_num = 0
-                for module in cross_attn_modules:
-                        self.add_field_cross_attn_modules(module, 't2i0_last_attn_map', None)
-                        self.add_field_cross_attn_modules(module, 't2i0_step', torch.tensor([-1]).to(device=shared.device))
-                        self.add_field_cross_attn_modules(module, 't2i0_step_start', torch.tensor([step_start]).to(device=shared.device))
-                        self.add_field_cross_attn_modules(module, 't2i0_step_end', torch.tensor([step_end]).to(device=shared.device))
-                        self.add_field_cross_attn_modules(module, 't2i0_ema', None)
-                        self.add_field_cross_attn_modules(module, 't2i0_ema_factor', torch.tensor([ema_factor]).to(device=shared.device, dtype=torch.float16))
-                        self.add_field_cross_attn_modules(module, 'plot_num', torch.tensor([plot_num]).to(device=shared.device))
-                        self.add_field_cross_attn_modules(module, 't2i0_to_v_map', None)
-                        self.add_field_cross_attn_modules(module.to_v, 't2i0_parent_module', [module])
-                        self.add_field_cross_attn_modules(module, 't2i0_token_count', torch.tensor(token_count).to(device=shared.device, dtype=torch.int64))
-                        if tokens is not None:
-                                self.add_field_cross_attn_modules(module, 't2i0_tokens', torch.tensor(tokens).to(device=shared.device, dtype=torch.int64))
-                        else:
-                                self.add_field_cross_attn_modules(module, 't2i0_tokens', None)
-
-                        plot_num += 1
-
-                # def cross_token_non_maximum_suppression_pre(module, args, kwargs):
-                #         pass
-                #         pass
-
-                def cross_token_non_maximum_suppression(module, input, kwargs, output):
-                        module.t2i0_step += 1
-
-                        context = kwargs.get('context', None)
-                        if context is None:
-                                return
-                        if context.shape[1] % 77 != 0:
-                                logger.error("Context shape is not divisible by 77, cannot run T2I-0")
-                                return
-
-                        current_step = module.t2i0_step
-                        start_step = module.t2i0_step_start
-                        end_step = module.t2i0_step_end
-
-                        # Select token indices, default is ALL tokens
-                        token_count = module.t2i0_token_count
-                        token_indices = module.t2i0_tokens
-
-                        if current_step > end_step and end_step > 0:
-                                return
-                        if current_step < start_step:
-                                return
-
-                        batch_size, sequence_length, inner_dim = output.shape
-
-                        max_dims = width*height
-                        factor = math.isqrt(max_dims // sequence_length) # should be a square of 2
-                        downscale_width = width // factor
-                        downscale_height = height // factor
-                        if downscale_width * downscale_height != sequence_length:
-                                print(f"Error: Width: {width}, height: {height}, Downscale width: {downscale_width}, height: {downscale_height}, Factor: {factor}, Max dims: {max_dims}\n")
-                                return
-
-                        # h = module.heads
-                        # head_dim = inner_dim // h
-                        dtype = output.dtype
-                        device = output.device
-
-                        # Multiply text embeddings into visual embeddings
-                        to_v_map = module.t2i0_to_v_map.detach().clone()
-                        to_v_inner_dim = to_v_map.size(-2)
-                        to_v_map = (to_v_map @ output.transpose(1, 2)).transpose(1, 2)
-
-                        to_v_attention_map = to_v_map.view(batch_size, downscale_height, downscale_width, to_v_inner_dim)
-
-                        # Original attention map
-                        attention_map = output.view(batch_size, downscale_height, downscale_width, inner_dim)
-
-                        if token_indices is None:
-                                selected_tokens = torch.tensor(list(range(1, token_count.item())))
-                        elif len(token_indices) == 0:
-                                selected_tokens = torch.tensor(list(range(1, token_count.item())))
-                        else:
-                                selected_tokens = module.t2i0_tokens
-
-                        if module.t2i0_ema is None:
-                                module.t2i0_ema = output.detach().clone()
-
-                        # Extract the attention maps for the selected tokens
-                        AC = to_v_attention_map[:, :, :, selected_tokens]  # Extracting relevant attention maps
-
-                        # Extract and process the selected attention maps
-                        # GaussianBlur expects the input [..., C, H, W]
-                        gaussian_blur = GaussianBlur(kernel_size=3, sigma=1)
-                        AC = AC.permute(0, 3, 1, 2)
-                        AC = gaussian_blur(AC)  # Applying Gaussian smoothing
-                        AC = AC.permute(0, 2, 3, 1)
-
-                        # Find the maximum contributing token for each pixel
-                        M = torch.argmax(AC, dim=-1)
-                        one_hot_M = F.one_hot(M, num_classes=to_v_attention_map.size(-1)).to(dtype=dtype, device=device)
-
-                        # the attention map is of shape [batch_size, height, width, inner_dim]
-                        one_hot_M_z = rearrange(one_hot_M, 'b h w c -> b (h w) c')
-                        one_hot_M_z = one_hot_M_z @ module.t2i0_to_v_map
-                        one_hot_M_z = rearrange(one_hot_M_z, 'b (h w) c -> b h w c', h=downscale_height, w=downscale_width)
-
-                        suppressed_attention_map = one_hot_M_z * attention_map
-
-                        # Reshape back to original dimensions
-                        suppressed_attention_map = suppressed_attention_map.view(batch_size, sequence_length, inner_dim)
-
-                        # Calculate the EMA of the suppressed attention map
-                        if module.t2i0_ema_factor > 0:
-                                ema = module.t2i0_ema
-                                ema_factor = module.t2i0_ema_factor / (1 + current_step)
-                                # Add the suppressed attention map to the EMA
-                                ema = ema_factor * ema + (1 - ema_factor) * suppressed_attention_map
-                                module.t2i0_ema = ema
-                                out_tensor = (1 -alpha) * output + (alpha) * ema
-                                #out_tensor = (1-alpha) * ema + alpha * suppressed_attention_map
-                        else:
-                                out_tensor = (1-alpha) * output + alpha * suppressed_attention_map
-
-                        return out_tensor
-
-                def t2i0_to_k_hook(module, input, kwargs, output):
-                        pass
-                        pass
-
-                def t2i0_to_v_hook(module, input, kwargs, output):
-                        module.t2i0_parent_module[0].t2i0_to_v_map = output
-
-                # Hook
+                manager = get_hook_manager()
+                if manager is None:
+                        logger.error("No model loaded, cannot run T2I-0")
+                        return
+                # only the denoiser forward, auxiliary passes like the PAG forward would advance the step counters and EMAs
                 for module in cross_attn_modules:
-                        # handle = module.to_k.register_forward_hook(t2i0_to_k_hook, with_kwargs=True)
-                        handle = module.to_v.register_forward_hook(t2i0_to_v_hook, with_kwargs=True)
-                        handle = module.register_forward_hook(cross_token_non_maximum_suppression, with_kwargs=True)
-                        # handle = module.register_forward_pre_hook(cross_token_non_maximum_suppression_pre, with_kwargs=True)
+                        manager.install(module.to_v, T2I0_HOOK_NAME, t2i0_to_v_hook, owner=module, passes=PassType.DENOISE)
+                        manager.install(module, T2I0_HOOK_NAME, cross_token_non_maximum_suppression, passes=PassType.DENOISE)
+                manager.activate(T2I0_HOOK_NAME, T2I0HookContext(alpha, width, height, ema_factor, step_start, step_end, tokens, token_count, mask_mode, mask_refresh, mask_stride, mask_drift, ema_storage, ema_budget, tile_size))
 
         def get_cross_attn_modules(self):
                 """ Get all cross attention modules """
                 try:
-                        m = shared.sd_model
-                        nlm = m.network_layer_mapping
-                        cross_attn_modules = [m for m in nlm.values() if 'CrossAttention' in m.__class__.__name__ and 'attn2' in m.network_layer_name]
-                        return cross_attn_modules
-                except AttributeError:
-                        logger.exception("AttributeError while getting cross attention modules")
-                        return []
+                        layer_index = get_layer_index()
+                        if layer_index is None:
+                                return []
+                        return layer_index.select(attn='attn2')
                 except Exception:
                         logger.exception("Error while getting cross attention modules")
                         return []
 
-        def add_field_cross_attn_modules(self, module, field, value):
-                """ Add a field to a module if it doesn't exist """
-                if not hasattr(module, field):
-                        setattr(module, field, value)
-
-        def remove_field_cross_attn_modules(self, module, field):
-                """ Remove a field from a module if it exists """
-                if hasattr(module, field):
-                        delattr(module, field)
-
         def on_cfg_denoiser_callback(self, params: CFGDenoiserParams, t2i0_params: list[T2I0StateParams]):
                 if isinstance(params.text_cond, dict):
                         text_cond = params.text_cond['crossattn'] # SD XL
@@ -584,13 +537,17 @@ class T2I0ExtensionScript(UIWrapper):
                 if step > step_end:
                         return
 
-                for batch_idx, batch in enumerate(text_cond):
-                        window = list(range(0, len(batch)))
-                        f_bar = self.correction_by_similarities(batch, window, score_threshold, window_size, correction_strength, tokens)
-                        if isinstance(params.text_cond, dict):
-                                params.text_cond['crossattn'][batch_idx] = f_bar
-                        else:
-                                params.text_cond[batch_idx] = f_bar
+                if correction_strength == 0:
+                        return
+
+                # the cond only changes between prompt schedule segments, correct it once per segment
+                cache_key = (window_size, score_threshold, correction_strength, tuple(tokens))
+                f_bar = sp.cbs_cache.get(cache_key, text_cond)
+                if f_bar is None:
+                        window = list(range(0, text_cond.shape[1]))
+                        f_bar = self.correction_by_similarities(text_cond, window, score_threshold, window_size, correction_strength, tokens)
+                        sp.cbs_cache.put(cache_key, text_cond, f_bar)
+                text_cond.copy_(f_bar)
                 return
 
         def get_xyz_axis_options(self) -> dict:
@@ -604,10 +561,30 @@ class T2I0ExtensionScript(UIWrapper):
                         xyz_grid.AxisOption("[T2I-0] CbS Correction Strength", float, t2i0_apply_field("t2i0_correction_strength")),
                         xyz_grid.AxisOption("[T2I-0] CTNMS Alpha", float, t2i0_apply_field("t2i0_ctnms_alpha")),
                         xyz_grid.AxisOption("[T2I-0] CTNMS EMA Smoothing Factor", float, t2i0_apply_field("t2i0_ema_factor")),
+                        xyz_grid.AxisOption("[T2I-0] CTNMS Mask", str, t2i0_apply_field("t2i0_ctnms_mask_mode"), choices=lambda: CTNMS_MASK_MODES),
+                        xyz_grid.AxisOption("[T2I-0] CTNMS Mask Refresh", str, t2i0_apply_field("t2i0_ctnms_mask_refresh"), choices=lambda: CTNMS_MASK_REFRESH_MODES),
+                        xyz_grid.AxisOption("[T2I-0] CTNMS Mask Stride", int, t2i0_apply_field("t2i0_ctnms_mask_stride")),
+                        xyz_grid.AxisOption("[T2I-0] CTNMS Mask Drift Threshold", float, t2i0_apply_field("t2i0_ctnms_mask_drift")),
+                        xyz_grid.AxisOption("[T2I-0] CTNMS EMA Storage", str, t2i0_apply_field("t2i0_ctnms_ema_storage"), choices=lambda: CTNMS_EMA_STORAGE_MODES),
+                        xyz_grid.AxisOption("[T2I-0] CTNMS EMA Budget (MB)", float, t2i0_apply_field("t2i0_ctnms_ema_budget")),
+                        xyz_grid.AxisOption("[T2I-0] CTNMS Tile Size", int, t2i0_apply_field("t2i0_ctnms_tile_size")),
                 }
                 return extra_axis_options
 
 
+# upper bound of the elements of one chunk of the batched CbS products
+CBS_CHUNK_ELEMENTS = 2 ** 24
+
+
+@lru_cache(maxsize=8)
+def cbs_window_matrix(n: int, gamma: int, min_idx: int, max_idx: int, device) -> torch.Tensor:
+        """ Banded [n, n] window of CbS, row c selects the tokens within gamma of token c in [min_idx, max_idx) """
+        idx = torch.arange(n, device=device)
+        in_window = (idx.unsqueeze(0) - idx.unsqueeze(1)).abs() <= gamma
+        in_range = (idx >= min_idx) & (idx < max_idx)
+        return (in_window & in_range.unsqueeze(0)).float()
+
+
 def plot_attention_map(attention_map: torch.Tensor, title, x_label="X", y_label="Y", save_path=None, plot_type="default"):
         """ Plots an attention map using matplotlib.pyplot
                 Arguments:
@@ -681,56 +658,3 @@ def get_token_count(text, steps, is_positive: bool = True):
     prompts = [prompt_text for step, prompt_text in flat_prompts]
     token_count, max_length = max([sd_hijack.model_hijack.get_prompt_lengths(prompt) for prompt in prompts], key=lambda args: args[0])
     return token_count, max_length
-
-
-# thanks torch; removing hooks DOESN'T WORK
-# thank you to @ProGamerGov for this https://github.com/pytorch/pytorch/issues/70455
-def _remove_all_forward_hooks(
-    module: torch.nn.Module, hook_fn_name: Optional[str] = None
-) -> None:
-    """
-    This function removes all forward hooks in the specified module, without requiring
-    any hook handles. This lets us clean up & remove any hooks that weren't property
-    deleted.
-
-    Warning: Various PyTorch modules and systems make use of hooks, and thus extreme
-    caution should be exercised when removing all hooks. Users are recommended to give
-    their hook function a unique name that can be used to safely identify and remove
-    the target forward hooks.
-
-    Args:
-
-        module (nn.Module): The module instance to remove forward hooks from.
-        hook_fn_name (str, optional): Optionally only remove specific forward hooks
-            based on their function's __name__ attribute.
-            Default: None
-    """
-
-    if hook_fn_name is None:
-        warn("Removing all active hooks can break some PyTorch modules & systems.")
-
-
-    def _remove_hooks(m: torch.nn.Module, name: Optional[str] = None) -> None:
-        if hasattr(module, "_forward_hooks"):
-            if m._forward_hooks != OrderedDict():
-                if name is not None:
-                    dict_items = list(m._forward_hooks.items())
-                    m._forward_hooks = OrderedDict(
-                        [(i, fn) for i, fn in dict_items if fn.__name__ != name]
-                    )
-                else:
-                    m._forward_hooks: Dict[int, Callable] = OrderedDict()
-
-    def _remove_child_hooks(
-        target_module: torch.nn.Module, hook_name: Optional[str] = None
-    ) -> None:
-        for _, child in target_module._modules.items():
-            if child is not None:
-                _remove_hooks(child, hook_name)
-                _remove_child_hooks(child, hook_name)
-
-    # Remove hooks from target submodules
-    _remove_child_hooks(module, hook_fn_name)
-
-    # Remove hooks from the target module
-    _remove_hooks(module, hook_fn_name)
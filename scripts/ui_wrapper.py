@@ -35,6 +35,27 @@ class UIWrapper:
     def unhook_callbacks(self) -> None:
         pass
 
+    # Guidance pipeline, the base script runs the stages of the active techniques for every denoiser step
+    # stages with a lower guidance_order run first
+    guidance_order: int = 0
+
+    def guidance_active(self) -> bool:
+        """ Whether the technique has an active job that takes part in the guidance pipeline """
+        return False
+
+    def on_cfg_denoiser(self, params) -> None:
+        pass
+
+    def on_cfg_denoised(self, params) -> None:
+        pass
+
+    def on_cfg_after_cfg(self, params) -> None:
+        pass
+
+    def combine_denoised(self, x_out, conds_list, uncond, cond_scale):
+        """ Return the combined prediction to take over combine_denoised of the denoiser, or None """
+        return None
+
     def get_xyz_axis_options(self) -> dict:
         raise NotImplementedError
 
@@ -0,0 +1,141 @@
+""" The T2I-0 CTNMS hook must not synchronize the host with the device on the sampling steps
+
+Only needs torch, run from the extension root:
+    python -m pytest tests
+
+Plans are compiled on the first forward of a job, so every test runs one warm-up step before checking.
+The Adaptive mask refresh reads the drift back to the host once per forward (drift.item() in begin_forward),
+it is the only sync on the hook path and is counted as such below.
+"""
+import os
+import sys
+from contextlib import contextmanager
+from typing import Optional
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.incant_utils.hook_manager import PassType, StepContext  # noqa: E402
+from scripts.incant_utils.ctnms import T2I0HookContext, cross_token_non_maximum_suppression  # noqa: E402
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+IMAGE_SIZE = 64 # pixels, the first layer is 8x8 and the second 4x4
+
+
+class HostSyncError(AssertionError):
+        pass
+
+
+@contextmanager
+def no_host_sync(allowed_items: Optional[list] = None):
+        """ Fail on every read of a device value, CUDA sync debug mode on GPU and patched tensor reads everywhere
+        Arguments:
+                allowed_items: list (optional) - Let item() through and append its result, the caller checks the count.
+                        The CUDA sync debug mode stays off then, since item() syncs
+        """
+        patched = {name: getattr(torch.Tensor, name) for name in ('item', 'tolist', 'nonzero', '__bool__')}
+
+        def fail(*args, **kwargs):
+                raise HostSyncError("host-device sync in the CTNMS hook")
+
+        def counted_item(tensor):
+                value = patched['item'](tensor)
+                allowed_items.append(value)
+                return value
+
+        for name in patched:
+                setattr(torch.Tensor, name, fail)
+        if allowed_items is not None:
+                torch.Tensor.item = counted_item
+        elif DEVICE == 'cuda':
+                torch.cuda.set_sync_debug_mode("error")
+        try:
+                yield
+        finally:
+                for name, fn in patched.items():
+                        setattr(torch.Tensor, name, fn)
+                if DEVICE == 'cuda':
+                        torch.cuda.set_sync_debug_mode("default")
+
+
+def make_layers(batch_size=2, inner_dim=32):
+        """ (module, to_v output, attention output, context) of two cross attention layers of different resolutions """
+        layers = []
+        for sequence_length in (64, 16):
+                module = torch.nn.Identity()
+                to_v = torch.randn(batch_size, 77, inner_dim, device=DEVICE)
+                output = torch.randn(batch_size, sequence_length, inner_dim, device=DEVICE)
+                context = torch.randn(batch_size, 77, 16, device=DEVICE)
+                layers.append((module, to_v, output, context))
+        return layers
+
+
+def make_step_context(step: int) -> StepContext:
+        step_context = StepContext()
+        step_context.sampling_step = step
+        step_context.total_sampling_steps = 10
+        step_context.pass_type = PassType.DENOISE
+        step_context.cond_rows = 1
+        step_context.batch_rows = 2
+        return step_context
+
+
+def run_forward(t2i0_context, step_context, layers):
+        results = []
+        for module, to_v, output, context in layers:
+                t2i0_context.to_v_map[module] = to_v
+                results.append(cross_token_non_maximum_suppression(t2i0_context, step_context, module, {'context': context}, output.clone()))
+        return results
+
+
+def make_context(**kwargs):
+        options = dict(mask_mode='Per Layer', mask_refresh='Stride', mask_stride=1, mask_drift=0.1, ema_storage='Full', ema_budget=0, tile_size=0)
+        options.update(kwargs)
+        return T2I0HookContext(0.1, IMAGE_SIZE, IMAGE_SIZE, 2.0, 0, 10, [], 10, **options)
+
+
+@pytest.mark.parametrize('options', [
+        {},
+        {'mask_mode': 'Shared', 'mask_stride': 2},
+        {'ema_storage': 'Downsampled', 'tile_size': 16},
+        {'ema_storage': 'Half Precision', 'ema_budget': 1},
+])
+def test_ctnms_hook_has_no_host_sync(options):
+        t2i0_context = make_context(**options)
+        layers = make_layers()
+        run_forward(t2i0_context, make_step_context(0), layers)
+        with no_host_sync():
+                for step in range(1, 4):
+                        results = run_forward(t2i0_context, make_step_context(step), layers)
+        for result, (_, _, output, _) in zip(results, layers):
+                assert result.shape == output.shape
+                # only the cond row is suppressed
+                assert torch.equal(result[1:], output[1:])
+
+
+def test_adaptive_mask_refresh_syncs_once_per_forward():
+        t2i0_context = make_context(mask_refresh='Adaptive')
+        layers = make_layers()
+        run_forward(t2i0_context, make_step_context(0), layers)
+        items = []
+        with no_host_sync(allowed_items=items):
+                for step in range(1, 4):
+                        run_forward(t2i0_context, make_step_context(step), layers)
+                        assert len(items) == step
+
+
+def test_uncond_chunk_is_left_unchanged():
+        """ With batch_cond_uncond off the denoiser runs the cond and the uncond rows as separate forwards """
+        t2i0_context = make_context()
+        layers = make_layers(batch_size=1)
+        for step in range(0, 2):
+                step_context = make_step_context(step)
+                cond_results = run_forward(t2i0_context, step_context, layers)
+                step_context.row_offset = 1
+                uncond_results = run_forward(t2i0_context, step_context, layers)
+        for result, (_, _, output, _) in zip(cond_results, layers):
+                assert not torch.equal(result, output)
+        assert uncond_results == [None] * len(layers)